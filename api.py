@@ -4,20 +4,25 @@ move game logic to another file. Ideally the API will be simple, concerned
 primarily with communication to/from the API's users."""
 
 import logging
+import time
 import endpoints
 from protorpc import remote, messages, message_types
 from google.appengine.api import memcache
-from google.appengine.api import taskqueue
 
 
-from models import User, Question, Turn, TriviaGame, GameSummary, Score
+from models import User, Question, QuestionCatalogue, TriviaGame, \
+    GameSummary, Score, ScoreHistogram, GameStats
+
+from models import GameConflictError, TurnToken
 
 from models import QuestionForm, TriviaQuestionForm, ClueForm, TriviaGameForm,\
     NewTriviaGameForm, GameSummaryForm, GameSummaryForms, GameDetailForm, \
     GameDetailForms, TriviaGameForms, DataForm, ScoreForm, ScoreForms, \
-    RankForm, RankForms, StringMessage
+    RankForm, RankForms, UserRankForm, StringMessage
 
-from utils import get_by_urlsafe, getFirstKey
+from utils import get_by_urlsafe, get_key_by_urlsafe, get_cursor_by_urlsafe, \
+    get_page_size, schedule_task
+from instrumentation import instrument
 
 NEW_TRIVIA_GAME_REQUEST = endpoints.ResourceContainer(NewTriviaGameForm)
 
@@ -26,6 +31,12 @@ GET_TRIVIA_GAME_REQUEST = endpoints.ResourceContainer(
 
 NEW_QUESTION_REQUEST = endpoints.ResourceContainer(QuestionForm)
 
+IMPORT_QUESTIONS_REQUEST = endpoints.ResourceContainer(
+    gcs_path=messages.StringField(1, required=True),
+    file_format=messages.StringField(2, required=False, default='jsonl'),)
+
+IMPORT_FILE_FORMATS = ('jsonl', 'csv')
+
 GET_QUESTION_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,)
 
@@ -33,11 +44,20 @@ GENERIC_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,)
 
 HI_SCORE_GET_REQUEST = endpoints.ResourceContainer(
-    result_num=messages.IntegerField(1, required=False, default=0),)
+    result_num=messages.IntegerField(1, required=False, default=0),
+    page_token=messages.StringField(2, required=False),)
+
+RANKINGS_REQUEST = endpoints.ResourceContainer(
+    result_num=messages.IntegerField(1, required=False, default=0),
+    page_token=messages.StringField(2, required=False),)
+
+HIGH_SCORE_PAGE_SIZE = 25
+MAX_HIGH_SCORE_PAGE_SIZE = 100
 
 TAKE_TURN_REQUEST = endpoints.ResourceContainer(
     urlsafe_trivia_game_key=messages.StringField(1),
-    ans=messages.StringField(2),)
+    ans=messages.StringField(2),
+    turn_token=messages.StringField(3, required=False),)
 
 GET_CLUE_REQUEST = endpoints.ResourceContainer(
         urlsafe_trivia_game_key=messages.StringField(1),)
@@ -49,8 +69,21 @@ ANSWER_QUESTION_REQUEST = endpoints.ResourceContainer(
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
 
+USER_HISTORY_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    page_size=messages.IntegerField(2, required=False),
+    page_token=messages.StringField(3, required=False),)
+
+HISTORY_PAGE_SIZE = 10
+MAX_HISTORY_PAGE_SIZE = 50
+
 MEMCACHE_CORRECT_ANSWER_AVERAGE = 'CORRECT_ANSWER_AVERAGE'
 
+# Game state saved only to the game cache reaches the datastore within this
+# many seconds
+GAME_FLUSH_WINDOW = 30
+GAME_CONFLICT_MESSAGE = 'The game was changed by another request, try again'
+
 
 @endpoints.api(name='trivia', version='v1')
 class TriviaApi(remote.Service):
@@ -60,28 +93,33 @@ class TriviaApi(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrument
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        if not request.user_name:
+            raise endpoints.BadRequestException('A user name is required!')
+
+        # Users are keyed by name, so the transaction in new_user enforces
+        # uniqueness. Creates an associated Score for this user as well.
+        user = None
+        if not User.get_by_name(request.user_name):
+            user = User.new_user(request.user_name, request.email)
+        if not user:
             raise endpoints.ConflictException(
                     'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
 
-        # Create an associated Score for this user
-
-        score = Score(user=user.key)
-        score.put()
+        ScoreHistogram.move(None, 0)
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
     @staticmethod
-    def _getPlayerReminder(game, name):
+    def _getPlayerReminder(game, name, question=None):
 
-        clues_used = game.get_latest_turn().get().clues_used
+        clues_used = game.get_latest_turn().clues_used
 
-        q_key = game.get_current_question()
-        question = q_key.get()
+        if question is None:
+            q_key = game.get_current_question()
+            question = Question.get_cached(q_key)
         (ansA, ansB, ansC, ansD) = list(question.answers.values())
 
         body = "Hi {},\n".format(name)
@@ -101,39 +139,80 @@ class TriviaApi(remote.Service):
 
         return body
 
+    @staticmethod
+    def _get_game(urlsafe_trivia_game_key):
+        """Returns the TriviaGame the key points to, read through the game
+        cache, or None if it does not exist"""
+        return TriviaGame.get_cached(
+            get_key_by_urlsafe(urlsafe_trivia_game_key, TriviaGame))
+
+    @staticmethod
+    def _save_game_state(game):
+        """Saves game state that does not complete a turn. It is written to
+        the game cache only, and the FlushGame task puts it at most once per
+        GAME_FLUSH_WINDOW however many requests change the game"""
+        try:
+            cached = game.save_cached()
+        except GameConflictError:
+            raise endpoints.ConflictException(GAME_CONFLICT_MESSAGE)
+        if cached:
+            TriviaApi._schedule_flush(game)
+        else:
+            game.put()
+
+    @staticmethod
+    def _schedule_flush(game):
+        """Queues the FlushGame task that puts the cached state of game"""
+        schedule_task('/tasks/flush_game',
+                      params={'game': game.key.urlsafe()},
+                      window=GAME_FLUSH_WINDOW)
+
     @staticmethod
     def _cache_average_correct_per_game():
-        """Populates memcache with the average correct answers per game"""
-        games = TriviaGame.query(TriviaGame.game_over == True).fetch()
-        if games:
-            correct_count = 0
-            count = len(games)
-            for game in games:
-                turns = game.turn_keys
-                total_correct_answers = sum([turn.get().is_correct
-                                            for turn in turns])
-            average = float(total_correct_answers)/count
+        """Populates memcache with the average correct answers per game,
+        read from the running totals kept by GameStats"""
+        stats = GameStats.get_totals()
+        if stats.games_finished:
             memcache.set(MEMCACHE_CORRECT_ANSWER_AVERAGE,
-                         'Average correct answer      \
-                         per game: {:.2f}'.format(average))
+                         'Average correct answers per game: {:.2f}, '
+                         'average clues used per game: {:.2f} '
+                         'over {} games'.format(stats.average_correct(),
+                                                stats.average_clues_used(),
+                                                stats.games_finished))
 
     @endpoints.method(request_message=NEW_TRIVIA_GAME_REQUEST,
                       response_message=TriviaGameForm,
                       path='triviagame',
                       name='new_trivia_game',
                       http_method='POST')
+    @instrument
     def new_triva_game(self, request):
         """Creates new trivia game"""
-        user = User.query(User.name == request.user_name).get()
+        if request.rounds is None or request.rounds < 1:
+            raise endpoints.BadRequestException(
+                    'A game needs at least one round!')
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        game = TriviaGame.new_game(user.key, request.rounds)
+        try:
+            category = Question.normalize_category(request.category)
+            difficulty = Question.normalize_difficulty(request.difficulty)
+        except ValueError, e:
+            raise endpoints.BadRequestException(str(e))
+
+        partition = QuestionCatalogue.partition_id(category, difficulty)
+        first, last = QuestionCatalogue.get_range(partition)
+        if (category or difficulty) and last < first:
+            raise endpoints.NotFoundException(
+                'No questions match that category and difficulty!')
+        game = TriviaGame.new_game(user.key, request.rounds, partition)
 
         # Use a task queue to update the average correct answers per game.
         # This operation is not needed to complete the creation of a new game
-        # so it is performed out of sequence.
-        taskqueue.add(url='/tasks/cache_average_correct_per_game')
+        # so it is performed out of sequence, at most once a minute however
+        # many games are created.
+        schedule_task('/tasks/cache_average_correct_per_game')
 
         return game.to_form('Good luck playing the Trivia Game!')
 
@@ -142,29 +221,32 @@ class TriviaApi(remote.Service):
                       path='triviagame/{urlsafe_trivia_game_key}',
                       name='get_trivia_game',
                       http_method='GET')
+    @instrument
     def get_trivia_game(self, request):
         """Return the current game state. Requires urlsafe_trivia_game_key"""
-        game = get_by_urlsafe(request.urlsafe_trivia_game_key, TriviaGame)
+        game = self._get_game(request.urlsafe_trivia_game_key)
         if game:
-            user_key = game.user
-            question_key = game.get_question_from_pool()
-
-            if question_key:
-                if len(game.turn_keys) == 0:
-                    # Create a new turn
-                    turn = Turn.new_turn(game.key, user_key, question_key)
-                    game.remove_question_from_pool(question_key)
-                    game.register_turn(turn.key)
-
-                # Get a question object
-                question = get_by_urlsafe(question_key.urlsafe(), Question)
-                return game.to_form(question.question,
-                                    question.answers.values())
-            else:
-                game.clear_game()
-                g_form = game.to_form('No available questions, Game aborted!')
-                game.key.delete()
-                return g_form
+            if len(game.get_turns()) == 0:
+                question_key = game.get_question_from_pool()
+                if not question_key:
+                    game.clear_game()
+                    return game.to_form(
+                        'No available questions, Game aborted!')
+
+                # Nothing is lost if the first turn is never flushed, it is
+                # simply started again
+                game.start_turn(question_key)
+                game.touch()
+                self._save_game_state(game)
+
+            # The player and the current question are fetched concurrently
+            form_future = game.to_form_async()
+            question = Question.get_cached(game.get_current_question())
+            form = form_future.get_result()
+            form.message = question.question
+            form.options = question.answers.values()
+            form.turn_token = TurnToken.issue(game, question)
+            return form
         else:
             raise endpoints.NotFoundException('Game not found!')
 
@@ -173,30 +255,51 @@ class TriviaApi(remote.Service):
                       path='triviagame/{urlsafe_trivia_game_key}/answer/{ans}',
                       name='take_turn',
                       http_method='PUT')
+    @instrument
     def take_turn(self, request):
         """ Take turn by answering a question in the triviagame. Requires
-            urlsafe_trivia_game_key and answer."""
+            urlsafe_trivia_game_key and answer. Given the turn_token of the
+            question, the answer is graded without reading the question."""
         # Get the game in question
-        game = get_by_urlsafe(request.urlsafe_trivia_game_key, TriviaGame)
+        game = self._get_game(request.urlsafe_trivia_game_key)
 
         if game.game_over:
             return game.to_form('Game already over!')
 
         game.rounds_remaining -= 1
 
-        turn_key = game.get_latest_turn()
+        turn = game.get_latest_turn()
 
-        if not turn_key:
+        if not turn:
             return game.to_form('Please get a game before taking a turn!')
 
-        turn = get_by_urlsafe(turn_key.urlsafe(), Turn)
-
-        question = get_by_urlsafe(turn.question_key.urlsafe(), Question)
+        # A token for this turn grades the answer in place of the question
+        token = None
+        if request.turn_token:
+            token = TurnToken.parse(request.turn_token)
+            if token and not token.matches(game):
+                token = None
+
+        # Start fetching the player for the response, then fetch the current
+        # and the next question in one batch while it is in flight
+        user_future = game.user.get_async()
+        next_question_key = None
+        if game.rounds_remaining >= 1:
+            next_question_key = game.get_question_from_pool()
+        if token:
+            # The token answers is_correct_answer and value like a Question
+            grader = token
+            (next_question,) = Question.get_multi_cached([next_question_key])
+        else:
+            grader, next_question = Question.get_multi_cached(
+                [turn.question_key, next_question_key])
+        # Cached in the context for to_form
+        user_future.get_result()
 
-        if question.is_correct_answer(request.ans):
+        if grader.is_correct_answer(request.ans):
             result = "You are correct. "
             turn.set_correct_answer()
-            points = question.value
+            points = grader.value
             if turn.clues_used != 0:
                 points -= 2**turn.clues_used
 
@@ -207,34 +310,39 @@ class TriviaApi(remote.Service):
 
         turn.set_answer_given(request.ans)
         turn.set_finished()
-        turn.put()
 
-        if game.rounds_remaining < 1:
-            game.end_game()
-            return game.to_form(result + ' Game over!')
-        else:
-            user_key = game.user
-            question_key = game.get_question_from_pool()
-            if question_key:
-                # Create a new turn
-                turn = Turn.new_turn(game.key, user_key, question_key)
-                game.remove_question_from_pool(question_key)
-                game.register_turn(turn.key)
-
-                # Get a question object
-                question = get_by_urlsafe(question_key.urlsafe(), Question)
-                game.put()
-                message = result + question.question
-                return game.to_form(message, question.answers.values())
+        try:
+            if game.rounds_remaining < 1:
+                game.end_game()
+                return game.to_form(result + ' Game over!')
+            elif next_question:
+                # Write the finished turn, the next turn and the game in one
+                # commit, while the response is built
+                game.start_turn(next_question_key)
+                put_future = game.commit_turn_async()
+
+                message = result + next_question.question
+                form = game.to_form(message, next_question.answers.values())
+                form.turn_token = TurnToken.issue(game, next_question)
+                put_future.get_result()
+                return form
             else:
                 game.end_game()
                 return game.to_form(result + ' No more questions, Game Over!')
+        except GameConflictError:
+            raise endpoints.ConflictException(GAME_CONFLICT_MESSAGE)
+        except Exception:
+            # The turn may be saved in the game cache without its put having
+            # succeeded, so leave it to FlushGame
+            self._schedule_flush(game)
+            raise
 
     @endpoints.method(request_message=NEW_QUESTION_REQUEST,
                       response_message=QuestionForm,
                       path='question/create',
                       name='create_question',
                       http_method='POST')
+    @instrument
     def create_question(self, request):
         """Creates a question that can be used in the trivia game"""
 
@@ -246,30 +354,68 @@ class TriviaApi(remote.Service):
 
         clues = [request.clue1, request.clue2]
 
-        newQuestion = Question.new_question(question, answers, clues)
+        try:
+            category = Question.normalize_category(request.category)
+            difficulty = Question.normalize_difficulty(request.difficulty)
+        except ValueError, e:
+            raise endpoints.BadRequestException(str(e))
+
+        newQuestion = Question.new_question(question, answers, clues,
+                                            category, difficulty)
 
         return newQuestion.to_form()
 
+    @endpoints.method(request_message=IMPORT_QUESTIONS_REQUEST,
+                      response_message=StringMessage,
+                      path='question/import',
+                      name='import_questions',
+                      http_method='POST')
+    @instrument
+    def import_questions(self, request):
+        """Imports the questions in a JSONL or CSV file in Cloud Storage,
+        given as /bucket/object. The file is read in batches by a task, so
+        this returns as soon as the import is queued"""
+        if request.file_format not in IMPORT_FILE_FORMATS:
+            raise endpoints.BadRequestException(
+                'file_format must be one of {}'.format(
+                    ', '.join(IMPORT_FILE_FORMATS)))
+        if not request.gcs_path.startswith('/') or \
+                request.gcs_path.count('/') < 2:
+            raise endpoints.BadRequestException(
+                'gcs_path must look like /bucket/object')
+
+        job = str(int(time.time() * 1000))
+        schedule_task('/tasks/import_questions', window=None,
+                      params={'path': request.gcs_path,
+                              'format': request.file_format,
+                              'job': job})
+        return StringMessage(message='Importing questions from {}'.format(
+            request.gcs_path))
+
     @endpoints.method(request_message=GET_CLUE_REQUEST,
                       response_message=StringMessage,
                       path='triviagame/{urlsafe_trivia_game_key}/clue',
                       name='get_clue',
                       http_method='GET')
+    @instrument
     def get_clue(self, request):
         """Retrieve a clue for a question. Requires urlsafe_trivia_game_key"""
-        game = get_by_urlsafe(request.urlsafe_trivia_game_key, TriviaGame)
+        game = self._get_game(request.urlsafe_trivia_game_key)
         if game:
             if game.game_over:
                 return StringMessage(message='Game already over!')
 
-            turn_key = game.get_latest_turn()
-            turn = get_by_urlsafe(turn_key.urlsafe(), Turn)
+            turn = game.get_latest_turn()
+            if not turn:
+                return StringMessage(
+                        message='Please get a game before asking for a clue!')
 
-            question = get_by_urlsafe(turn.question_key.urlsafe(), Question)
+            question = Question.get_cached(turn.question_key)
             if turn.clues_used < 2:
                 clue = question.clues[turn.clues_used]
                 turn.used_clue()
-                turn.put()
+                game.touch()
+                self._save_game_state(game)
             else:
                 clue = 'You have used up all of your clues!'
 
@@ -283,10 +429,13 @@ class TriviaApi(remote.Service):
                       path='question/retrieve',
                       name='get_question',
                       http_method='GET')
+    @instrument
     def get_question(self, request):
-        """Retrieve a question."""
-        q = Question.query()
-        question = q.get()
+        """Retrieve a question at random."""
+        question_keys = Question.sample_keys(1)
+        question = None
+        if question_keys:
+            question = Question.get_cached(question_keys[0])
 
         if question:
             return question.to_trivia_form()
@@ -298,11 +447,14 @@ class TriviaApi(remote.Service):
                       path='question/{urlsafe_question_key}/answer/{answer}',
                       name='answer_question',
                       http_method='POST')
+    @instrument
     def answer_question(self, request):
         """Answer a question and check correctness. Requires urlsafe_question_key
            and answer"""
         wsqk = request.urlsafe_question_key
-        question = get_by_urlsafe(wsqk, Question)
+        question = Question.get_cached(get_key_by_urlsafe(wsqk, Question))
+        if not question:
+            raise endpoints.NotFoundException('Question not found!')
 
         if question.is_correct_answer(request.answer):
             result = "is correct."
@@ -317,6 +469,7 @@ class TriviaApi(remote.Service):
                       path='triviagame/{urlsafe_trivia_game_key}/details',
                       name='get_trivia_game_history',
                       http_method='GET')
+    @instrument
     def get_trivia_game_history(self, request):
         """Retrieve the history for one completed game. Requires
            urlsafe_trivia_game_key."""
@@ -340,61 +493,88 @@ class TriviaApi(remote.Service):
         else:
             raise endpoints.NotFoundException('Game not found!')
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @staticmethod
+    def _get_history_page(user, request):
+        """Returns one page of a user's GameSummaries, most recent first, and
+        the token for the next page"""
+        page_size = get_page_size(request.page_size, HISTORY_PAGE_SIZE,
+                                  MAX_HISTORY_PAGE_SIZE)
+        cursor = get_cursor_by_urlsafe(request.page_token)
+
+        q = GameSummary.query(GameSummary.user == user.key)
+        summaries, next_cursor, more = q.order(-GameSummary.date).fetch_page(
+            page_size, start_cursor=cursor)
+
+        if more and next_cursor:
+            return summaries, next_cursor.urlsafe()
+        return summaries, None
+
+    @endpoints.method(request_message=USER_HISTORY_REQUEST,
                       response_message=GameSummaryForms,
                       path='triviagame/user/{user_name}/summary',
                       name='get_user_trivia_game_summary',
                       http_method='GET')
+    @instrument
     def get_user_trivia_game_summary(self, request):
         """Returns a summary of an individual User's games. This
            includes the user name, date, number of questions answered,
            number answered correctly and incorrectly, the number of clues
-           used and the total score for the game. Requires user_name."""
-        user = User.query(User.name == request.user_name).get()
+           used and the total score for the game. Results are paged, most
+           recent first. Requires user_name, optionally accepts page_size
+           and the page_token returned with the previous page."""
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        sums = GameSummary.query(GameSummary.user == user.key)
-        return GameSummaryForms(items=[smy.to_summary_form() for smy in sums])
+        sums, next_page_token = self._get_history_page(user, request)
+        return GameSummaryForms(items=[smy.to_summary_form(user.name)
+                                       for smy in sums],
+                                next_page_token=next_page_token)
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_HISTORY_REQUEST,
                       response_message=GameDetailForms,
                       path='triviagame/user/{user_name}/detail',
                       name='get_user_trivia_game_detail',
                       http_method='GET')
+    @instrument
     def get_user_trivia_game_detail(self, request):
         """Returns a detailed listing of an individual User's games. This
            includes all questions for each game, the given answer for each
            question, whether the given answer correct or not, how many clues
            were used to answer each question, how many points were awarded
-           for each question and the date for the question.
-           Requires user_name. """
-        user = User.query(User.name == request.user_name).get()
+           for each question and the date for the question. Games are
+           paged, most recent first, while the totals cover all of the
+           user's games. Requires user_name, optionally accepts page_size
+           and the page_token returned with the previous page."""
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
 
-        items = []
-        data = [0, 0, 0, 0]
-        summaries = GameSummary.query(GameSummary.user == user.key)
-        for summary in summaries:
-            items.extend(summary.to_detail_form())
-            data = [x + y for x, y in zip(data, summary.aggregate_data())]
+        summaries, next_page_token = self._get_history_page(user, request)
+
+        # Turns and questions for every summary are fetched in batches
+        items = GameSummary.to_detail_forms(summaries)
+
+        # The user's Score already holds the totals over all games
+        score = Score.get_for_user(user.key) or Score(user=user.key)
 
         return GameDetailForms(user_name=user.name, items=items,
-                               total_correct=data[1],
-                               total_incorrect=data[2],
-                               total_clues_used=data[3],
-                               total_points=data[0])
+                               total_correct=score.num_correct,
+                               total_incorrect=score.num_incorrect,
+                               total_clues_used=score.clues_used,
+                               total_points=score.score,
+                               next_page_token=next_page_token)
 
     @endpoints.method(request_message=USER_REQUEST,
                       response_message=TriviaGameForms,
                       path='triviagame/user/{user_name}/active',
                       name='get_user_games',
                       http_method='GET')
+    @instrument
     def get_user_games(self, request):
         """Returns the active games of a user. Requires user_name"""
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
@@ -403,30 +583,35 @@ class TriviaApi(remote.Service):
             .filter(TriviaGame.user == user.key)     \
             .filter(TriviaGame.game_over == False).fetch()
 
-        items = []
-        for game in games:
-            question = game.get_current_question().get()
-            question_asked = question.question
-            answers = question.answers.values()
+        questions = Question.get_multi_cached(
+            [game.get_current_question() for game in games])
 
-            items.append(game.to_form(question_asked, answers))
+        # Build every form concurrently
+        futures = []
+        for game, question in zip(games, questions):
+            if question:
+                futures.append(game.to_form_async(question.question,
+                                                  question.answers.values()))
+            else:
+                futures.append(game.to_form_async('Game not started yet!'))
 
-        return TriviaGameForms(items=items)
+        return TriviaGameForms(items=[future.get_result()
+                                      for future in futures])
 
     @endpoints.method(request_message=GET_TRIVIA_GAME_REQUEST,
                       response_message=StringMessage,
                       path='triviagame/{urlsafe_trivia_game_key}/cancel',
                       name='cancel_trivia_game',
                       http_method='DELETE')
+    @instrument
     def cancel_trivia_game(self, request):
         """Cancel an active game. Requires urlsafe_trivia_game_key."""
-        game = get_by_urlsafe(request.urlsafe_trivia_game_key, TriviaGame)
+        game = self._get_game(request.urlsafe_trivia_game_key)
         if game:
             if game.game_over:
                 return StringMessage(message='Game is over, cannot cancel!')
 
             game.clear_game()
-            game.key.delete()
 
             return StringMessage(message='Game cancelled!')
 
@@ -438,59 +623,85 @@ class TriviaApi(remote.Service):
                       path='scores/user/{user_name}',
                       name='get_user_score',
                       http_method='GET')
+    @instrument
     def get_user_score(self, request):
         """Returns an individual User's scores. Requires user_name."""
-        user = User.query(User.name == request.user_name).get()
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        score = Score.query(Score.user == user.key).get()
+        score = Score.get_for_user(user.key)
         if score:
             return score.to_score_form()
         else:
             raise endpoints.NotFoundException('Score not found!')
 
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=UserRankForm,
+                      path='scores/user/{user_name}/rank',
+                      name='get_user_rank',
+                      http_method='GET')
+    @instrument
+    def get_user_rank(self, request):
+        """Returns an individual User's rank and percentile, looked up in
+           the score histogram. Requires user_name."""
+        user = User.get_by_name(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        score = Score.get_for_user(user.key)
+        if score:
+            return score.to_rank_form()
+        else:
+            raise endpoints.NotFoundException('Score not found!')
+
     @endpoints.method(request_message=HI_SCORE_GET_REQUEST,
                       response_message=ScoreForms,
                       path='scores/highscores/{result_num}',
                       name='get_high_scores',
                       http_method='GET')
+    @instrument
     def get_high_scores(self, request):
-        """Retrieve the high scores to date. Optionally accepts
-           result_num which is the number of results wanted."""
-        sq = Score.query().order(-Score.score)
+        """Retrieve the high scores to date, a page at a time. Optionally
+           accepts result_num which is the number of results wanted (at
+           most 100) and the page_token returned with the previous page."""
+        page_size = get_page_size(request.result_num, HIGH_SCORE_PAGE_SIZE,
+                                  MAX_HIGH_SCORE_PAGE_SIZE)
+        cursor = get_cursor_by_urlsafe(request.page_token)
 
-        if request.result_num > 0:
-            scores = sq.fetch(limit=request.result_num)
-        else:
-            scores = sq.fetch()
+        sq = Score.query().order(-Score.score)
+        scores, next_cursor, more = sq.fetch_page(page_size,
+                                                  start_cursor=cursor)
 
-        return ScoreForms(items=[score.to_score_form() for score in scores])
+        next_page_token = next_cursor.urlsafe() if more and next_cursor \
+            else None
+        return ScoreForms(items=[score.to_score_form() for score in scores],
+                          next_page_token=next_page_token)
 
-    @endpoints.method(request_message=GENERIC_GET_REQUEST,
+    @endpoints.method(request_message=RANKINGS_REQUEST,
                       response_message=RankForms,
                       path='user/rankings',
                       name='get_rankings',
                       http_method='GET')
+    @instrument
     def get_rankings(self, request):
-        """Retrieve the user rankings to date."""
-        s = Score.query()
-        scores = s.order(-Score.score).order(Score.clues_used).fetch()
-
-        ranks = []
-        for score in scores:
-            name = score.user.get().name
-            denominator = float(score.num_correct + score.num_incorrect)
-            factor = score.num_correct/denominator
-            rank = round((10 * score.score * factor)) - score.clues_used
-            tup = (name, rank)
-            ranks.append(tup)
-
-        ranks = sorted(ranks, reverse=True, key=getFirstKey)
-
-        rankings = [RankForm(name=rank[0], ranking=rank[1]) for rank in ranks]
-
-        return RankForms(items=rankings)
+        """Retrieve the user rankings to date, a page at a time. Optionally
+           accepts result_num which is the number of results wanted (at
+           most 100) and the page_token returned with the previous page."""
+        page_size = get_page_size(request.result_num, HIGH_SCORE_PAGE_SIZE,
+                                  MAX_HIGH_SCORE_PAGE_SIZE)
+        cursor = get_cursor_by_urlsafe(request.page_token)
+
+        s = Score.query().order(-Score.ranking).order(-Score.score)
+        scores, next_cursor, more = s.fetch_page(page_size,
+                                                 start_cursor=cursor)
+
+        rankings = [RankForm(name=score.get_user_name(),
+                             ranking=score.ranking) for score in scores]
+
+        next_page_token = next_cursor.urlsafe() if more and next_cursor \
+            else None
+        return RankForms(items=rankings, next_page_token=next_page_token)
 
 
 api = endpoints.api_server([TriviaApi])
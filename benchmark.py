@@ -0,0 +1,273 @@
+"""benchmark.py - In-process load and latency benchmark for the Trivia API.
+Seeds users and questions into the App Engine testbed datastore, memcache
+and taskqueue stubs, drives scripted player sessions through TriviaApi and
+reports latency percentiles, datastore and memcache RPCs per call and
+entity sizes as JSON, so runs can be compared across commits. Stub timings
+are not production timings; compare runs made on the same machine.
+
+Usage:
+    python benchmark.py --sdk <path to google_appengine> --users 50 \\
+        --questions 500 --rounds 5 --output bench.json
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import time
+
+from tests.support import setup_sdk, setup_testbed
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Services whose RPCs are counted per call
+COUNTED_SERVICES = ('datastore_v3', 'memcache', 'taskqueue')
+
+# Entity kinds whose encoded sizes are reported, sampled up to this many each
+SIZE_SAMPLE = 200
+
+# Rounds of queued tasks run after the sessions, each may chain the next
+MAX_TASK_ROUNDS = 20
+
+CATEGORIES = ('history', 'science', 'sport', 'geography', 'music')
+DIFFICULTIES = ('easy', 'medium', 'hard')
+
+
+def percentile(values, pct):
+    """Returns the nearest-rank percentile of values"""
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(ordered))), 1)
+    return ordered[rank - 1]
+
+
+class Recorder(object):
+    """Times calls and counts the RPCs each one makes"""
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.rpcs = collections.defaultdict(collections.Counter)
+        self.errors = collections.Counter()
+        self._current = None
+
+    def install(self):
+        from google.appengine.api import apiproxy_stub_map
+
+        def hook(service, call, request, response):
+            if self._current is not None and service in COUNTED_SERVICES:
+                self.rpcs[self._current]['{}.{}'.format(service, call)] += 1
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'benchmark', hook)
+
+    def measure(self, name, func, *args):
+        """Runs func as one request and records it under name. Returns its
+        result, or None if it raised"""
+        from google.appengine.ext import ndb
+
+        # Each call is a new request, with an empty ndb context cache
+        ndb.get_context().clear_cache()
+        self._current = name
+        start = time.time()
+        try:
+            return func(*args)
+        except Exception:
+            logging.exception('%s failed', name)
+            self.errors[name] += 1
+            return None
+        finally:
+            self.latencies[name].append((time.time() - start) * 1000)
+            self._current = None
+
+    def report(self):
+        report = {}
+        for name, latencies in sorted(self.latencies.items()):
+            calls = len(latencies)
+            report[name] = {
+                'calls': calls,
+                'errors': self.errors[name],
+                'latency_ms': {
+                    'mean': round(sum(latencies) / calls, 3),
+                    'p50': round(percentile(latencies, 50), 3),
+                    'p95': round(percentile(latencies, 95), 3),
+                    'p99': round(percentile(latencies, 99), 3)},
+                'rpcs_per_call': dict(
+                    (rpc, round(float(count) / calls, 3))
+                    for rpc, count in sorted(self.rpcs[name].items()))}
+        return report
+
+
+class Session(object):
+    """Calls the API as the endpoints server would, with the combined
+    request message of each method's ResourceContainer"""
+    def __init__(self, recorder):
+        import api
+        self.api = api
+        self.service = api.TriviaApi()
+        self.recorder = recorder
+
+    def call(self, method, container, **fields):
+        request = container.combined_message_class(**fields)
+        return self.recorder.measure(method, getattr(self.service, method),
+                                     request)
+
+    def play(self, user_name, rounds, clue_rate, use_tokens, rng):
+        """Plays one game from sign up to the leaderboards"""
+        api = self.api
+        self.call('create_user', api.USER_REQUEST, user_name=user_name,
+                  email='{}@example.com'.format(user_name))
+        game = self.call('new_triva_game', api.NEW_TRIVIA_GAME_REQUEST,
+                         user_name=user_name, rounds=rounds)
+        if game is None:
+            return
+        urlsafe = game.urlsafe_key
+
+        form = self.call('get_trivia_game', api.GET_TRIVIA_GAME_REQUEST,
+                         urlsafe_trivia_game_key=urlsafe)
+        while form is not None and not form.game_over:
+            if rng.random() < clue_rate:
+                self.call('get_clue', api.GET_CLUE_REQUEST,
+                          urlsafe_trivia_game_key=urlsafe)
+            form = self.call(
+                'take_turn', api.TAKE_TURN_REQUEST,
+                urlsafe_trivia_game_key=urlsafe,
+                ans=rng.choice(form.options) if form.options else '',
+                turn_token=form.turn_token if use_tokens else None)
+
+        self.call('get_user_trivia_game_summary', api.USER_HISTORY_REQUEST,
+                  user_name=user_name)
+        self.call('get_user_trivia_game_detail', api.USER_HISTORY_REQUEST,
+                  user_name=user_name)
+        self.call('get_user_games', api.USER_REQUEST, user_name=user_name)
+        self.call('get_user_rank', api.USER_REQUEST, user_name=user_name)
+
+    def leaderboards(self):
+        api = self.api
+        self.call('get_high_scores', api.HI_SCORE_GET_REQUEST)
+        self.call('get_rankings', api.RANKINGS_REQUEST)
+
+
+def seed_questions(count, rng):
+    """Imports count generated questions through Question.import_questions"""
+    from models import Question
+
+    rows = []
+    for i in range(count):
+        rows.append({'question': u'Benchmark question {}?'.format(i),
+                     'correct': u'right {}'.format(i),
+                     'wrong1': u'wrong {}a'.format(i),
+                     'wrong2': u'wrong {}b'.format(i),
+                     'wrong3': u'wrong {}c'.format(i),
+                     'clue1': u'first clue {}'.format(i),
+                     'clue2': u'second clue {}'.format(i),
+                     'category': rng.choice(CATEGORIES),
+                     'difficulty': rng.choice(DIFFICULTIES)})
+    for start in range(0, len(rows), 200):
+        Question.import_questions([Question.from_row(row)
+                                   for row in rows[start:start + 200]])
+
+
+def run_tasks(bed, recorder):
+    """Runs the queued push tasks through the task handlers until no more
+    are queued, recording each under its url"""
+    import webapp2
+    from google.appengine.ext import testbed
+    import main
+
+    stub = bed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    for i in range(MAX_TASK_ROUNDS):
+        tasks = stub.get_filtered_tasks()
+        if not tasks:
+            return
+        for queue in stub.GetQueues():
+            stub.FlushQueue(queue['name'])
+        for task in tasks:
+            request = webapp2.Request.blank(
+                task.url, method='POST', body=task.payload,
+                headers={'Content-Type':
+                         'application/x-www-form-urlencoded'})
+            recorder.measure(task.url, request.get_response, main.app)
+
+
+def entity_sizes():
+    """Returns the encoded size in bytes of a sample of each stored kind"""
+    from google.appengine.ext import ndb
+    from models import User, Question, TriviaGame, GameSummary, Score
+
+    sizes = {}
+    for model in (User, Question, TriviaGame, GameSummary, Score):
+        encoded = [len(ndb.model_to_protobuf(entity).Encode())
+                   for entity in model.query().fetch(SIZE_SAMPLE)]
+        if encoded:
+            sizes[model._get_kind()] = {
+                'sampled': len(encoded),
+                'mean': round(float(sum(encoded)) / len(encoded), 1),
+                'max': max(encoded)}
+    return sizes
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=APP_ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the google_appengine SDK directory')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--questions', type=int, default=500)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--clue-rate', type=float, default=0.3,
+                        help='chance of asking for a clue before a turn')
+    parser.add_argument('--no-tokens', action='store_true',
+                        help='answer without passing back turn tokens')
+    parser.add_argument('--no-tasks', action='store_true',
+                        help='leave queued tasks unrun')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the report to this file')
+    args = parser.parse_args()
+    if not args.sdk:
+        parser.error('pass --sdk or set APPENGINE_SDK')
+
+    setup_sdk(args.sdk)
+    sys.path.insert(0, APP_ROOT)
+    bed = setup_testbed()
+    try:
+        rng = random.Random(args.seed)
+        recorder = Recorder()
+        recorder.install()
+
+        started = time.time()
+        recorder.measure('seed_questions', seed_questions, args.questions,
+                         rng)
+        session = Session(recorder)
+        for i in range(args.users):
+            session.play('player{}'.format(i), args.rounds, args.clue_rate,
+                         not args.no_tokens, rng)
+            session.leaderboards()
+        if not args.no_tasks:
+            run_tasks(bed, recorder)
+
+        report = {'revision': git_revision(),
+                  'config': vars(args),
+                  'elapsed_s': round(time.time() - started, 3),
+                  'calls': recorder.report(),
+                  'entity_bytes': entity_sizes()}
+    finally:
+        bed.deactivate()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""instrumentation.py - Per endpoint and per handler cost accounting. An
+apiproxy hook counts the datastore and memcache RPCs of the request running
+on each thread. 'instrument' wraps the endpoint methods and 'dispatcher'
+wraps the webapp2 handlers. Costs are kept per instance in rolling one
+minute windows, and every request is also logged as one JSON line for
+log-based metrics and alerts."""
+
+import contextlib
+import functools
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from google.appengine.api import apiproxy_stub_map
+
+# Minutes of history kept by the rolling stats
+STATS_WINDOW_MINUTES = 15
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Prefix of the per request log line, for log-based metric filters
+LOG_PREFIX = 'request_stats '
+
+# Counter each datastore RPC is added to
+DATASTORE_COUNTERS = {'Get': 'datastore_gets',
+                      'Put': 'datastore_puts',
+                      'RunQuery': 'datastore_queries',
+                      'Next': 'datastore_query_batches',
+                      'Delete': 'datastore_deletes',
+                      'Commit': 'datastore_commits'}
+
+_local = threading.local()
+
+
+class RequestCost(object):
+    """The RPCs made and the time taken by one request"""
+    def __init__(self, name):
+        self.name = name
+        self.counts = defaultdict(int)
+        self.error = False
+        self.start = time.time()
+        self.elapsed_ms = None
+
+
+class RollingStats(object):
+    """Request costs per name in one minute windows, of which the last
+    STATS_WINDOW_MINUTES are kept"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._windows = deque()
+
+    @staticmethod
+    def _new_entry():
+        return {'requests': 0,
+                'errors': 0,
+                'latency_sum': 0.0,
+                'latency_max': 0.0,
+                'histogram': [0] * (len(LATENCY_BUCKETS_MS) + 1),
+                'counts': defaultdict(int)}
+
+    def record(self, cost):
+        minute = int(cost.start // 60)
+        with self._lock:
+            if not self._windows or self._windows[-1][0] != minute:
+                self._windows.append((minute, {}))
+            while self._windows[0][0] <= minute - STATS_WINDOW_MINUTES:
+                self._windows.popleft()
+
+            names = self._windows[-1][1]
+            entry = names.get(cost.name)
+            if entry is None:
+                entry = names[cost.name] = self._new_entry()
+            entry['requests'] += 1
+            entry['errors'] += cost.error
+            entry['latency_sum'] += cost.elapsed_ms
+            entry['latency_max'] = max(entry['latency_max'], cost.elapsed_ms)
+            entry['histogram'][self._bucket(cost.elapsed_ms)] += 1
+            for counter, count in cost.counts.items():
+                entry['counts'][counter] += count
+
+    @staticmethod
+    def _bucket(elapsed_ms):
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                return i
+        return len(LATENCY_BUCKETS_MS)
+
+    def snapshot(self, minutes=STATS_WINDOW_MINUTES):
+        """Returns the costs per name over the last minutes. Latency
+        percentiles are the upper bound of the histogram bucket they fall
+        in, and RPC counts are averaged per request"""
+        since = int(time.time() // 60) - minutes
+        totals = defaultdict(self._new_entry)
+        with self._lock:
+            for minute, names in self._windows:
+                if minute <= since:
+                    continue
+                for name, entry in names.items():
+                    total = totals[name]
+                    total['requests'] += entry['requests']
+                    total['errors'] += entry['errors']
+                    total['latency_sum'] += entry['latency_sum']
+                    total['latency_max'] = max(total['latency_max'],
+                                               entry['latency_max'])
+                    for i, count in enumerate(entry['histogram']):
+                        total['histogram'][i] += count
+                    for counter, count in entry['counts'].items():
+                        total['counts'][counter] += count
+
+        snapshot = {}
+        for name, total in totals.items():
+            requests = total['requests']
+            snapshot[name] = {
+                'requests': requests,
+                'errors': total['errors'],
+                'latency_ms': {
+                    'mean': round(total['latency_sum'] / requests, 1),
+                    'p50': self._percentile(total, 50),
+                    'p95': self._percentile(total, 95),
+                    'p99': self._percentile(total, 99),
+                    'max': round(total['latency_max'], 1),
+                    'histogram': zip(list(LATENCY_BUCKETS_MS) + ['inf'],
+                                     total['histogram'])},
+                'per_request': dict(
+                    (counter, round(float(count) / requests, 2))
+                    for counter, count in total['counts'].items())}
+        return snapshot
+
+    @staticmethod
+    def _percentile(total, pct):
+        rank = pct / 100.0 * total['requests']
+        seen = 0
+        for i, count in enumerate(total['histogram']):
+            seen += count
+            if seen >= rank and count:
+                if i < len(LATENCY_BUCKETS_MS):
+                    return LATENCY_BUCKETS_MS[i]
+                break
+        return round(total['latency_max'], 1)
+
+
+_stats = RollingStats()
+
+
+def get_stats(minutes=STATS_WINDOW_MINUTES):
+    """Returns the request costs this instance recorded over the last
+    minutes, by endpoint method or handler name"""
+    return _stats.snapshot(minutes)
+
+
+def _pre_call_hook(service, call, request, response):
+    cost = getattr(_local, 'cost', None)
+    if cost is None:
+        return
+    if service == 'datastore_v3' and call in DATASTORE_COUNTERS:
+        cost.counts[DATASTORE_COUNTERS[call]] += 1
+    elif service == 'memcache':
+        cost.counts['memcache_calls'] += 1
+
+
+def _post_call_hook(service, call, request, response):
+    cost = getattr(_local, 'cost', None)
+    if cost is None or service != 'memcache' or call != 'Get':
+        return
+    hits = response.item_size()
+    cost.counts['memcache_hits'] += hits
+    cost.counts['memcache_misses'] += request.key_size() - hits
+
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+    'instrumentation', _pre_call_hook)
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'instrumentation', _post_call_hook)
+
+
+@contextlib.contextmanager
+def measure(name):
+    """Records the RPCs and wall time of the block under name"""
+    cost = RequestCost(name)
+    _local.cost = cost
+    try:
+        yield cost
+    except Exception:
+        cost.error = True
+        raise
+    finally:
+        _local.cost = None
+        cost.elapsed_ms = (time.time() - cost.start) * 1000
+        _stats.record(cost)
+        logging.info('%s%s', LOG_PREFIX, json.dumps(
+            {'name': cost.name,
+             'ms': round(cost.elapsed_ms, 1),
+             'error': cost.error,
+             'counts': cost.counts}, sort_keys=True))
+
+
+def instrument(func):
+    """Decorator recording each call of an endpoint method under its name.
+    Goes below the endpoints.method decorator"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with measure(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def dispatcher(router, request, response):
+    """webapp2 dispatcher recording each request under the name of the
+    handler class that served it. Install with router.set_dispatcher"""
+    with measure(request.path) as cost:
+        rv = router.default_dispatcher(request, response)
+        handler = getattr(getattr(request, 'route', None), 'handler', None)
+        if isinstance(handler, type):
+            cost.name = handler.__name__
+        if response.status_int >= 500:
+            cost.error = True
+        return rv
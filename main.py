@@ -2,33 +2,226 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import csv
+import hashlib
+import json
 import logging
+import time
+from datetime import datetime, timedelta
 
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import mail, app_identity, taskqueue
+from google.appengine.ext import blobstore
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from api import TriviaApi
+from utils import schedule_task
+import instrumentation
 
-from models import User, TriviaGame
+from models import User, UserName, TriviaGame, GameSummary, Question, \
+    QuestionCatalogue, Score, ScoreHistogram, GameStats, Migration, \
+    USER_KEYS, GameConflictError
+
+
+def get_job_id(request):
+    """Returns the id of the run a chained task belongs to. The first task
+    of a run has no job param and is identified by its task name, which a
+    retry of it keeps, so a retried first batch cannot start a second chain"""
+    return (request.get('job') or
+            request.headers.get('X-AppEngine-TaskName') or
+            str(int(time.time() * 1000)))
+
+
+class CursorChainedTask(webapp2.RequestHandler):
+    """Base handler for jobs that walk a query one batch per request and
+    re-enqueue themselves with the next cursor until the query is done.
+    Subclasses supply the query and process each batch. Each run is tagged
+    with a job id so its continuation tasks can be named, and deduplicated,
+    per cursor."""
+    BATCH_SIZE = 100
+
+    def query(self):
+        raise NotImplementedError
+
+    def process(self, entities):
+        raise NotImplementedError
+
+    def chain_params(self):
+        """Extra parameters passed on to every continuation task. The query
+        must be rebuilt identically from them for the cursor to apply"""
+        return {}
+
+    def finish(self):
+        """Called after the last batch of the query was processed"""
+        pass
+
+    def job_id(self):
+        """Returns the id of the run, the same throughout the request"""
+        if getattr(self, '_job', None) is None:
+            self._job = get_job_id(self.request)
+        return self._job
+
+    def post(self):
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        entities, next_cursor, more = self.query().fetch_page(
+            self.BATCH_SIZE, start_cursor=cursor)
+
+        self.process(entities)
+
+        if more and next_cursor:
+            params = self.chain_params()
+            params.update({'job': self.job_id(),
+                           'cursor': next_cursor.urlsafe()})
+            schedule_task(self.request.path, window=None, params=params)
+        else:
+            self.finish()
+        self.response.set_status(204)
+
+
+# Players are reminded about games left this many hours without activity
+REMINDER_IDLE_HOURS = 1
+CUTOFF_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# Outbound mail is sent from this queue, its rate limit and retries are
+# configured in queue.yaml
+MAIL_QUEUE = 'mail'
+# Unfinished games are purged after this many days without activity, unless
+# the cron url gives days
+ABANDONED_GAME_DAYS = 30
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
-        """Send a reminder email to each User with an email about games.
-        Called every hour using a cron job"""
+        """Start the reminder pipeline for games idle past the threshold.
+        Called by a cron job"""
+        cutoff = datetime.now() - timedelta(hours=REMINDER_IDLE_HOURS)
+        schedule_task('/tasks/send_reminders',
+                      params={'cutoff': cutoff.strftime(CUTOFF_FORMAT)})
+
+
+class SendReminders(CursorChainedTask):
+    """Queue a reminder email to each User with an email about games that
+    have been idle since the cutoff. Walks the idle games a batch at a time,
+    fetching their users and current questions in batches. The emails are
+    sent by SendMail from the mail queue, one per user per day."""
+    BATCH_SIZE = 50
+
+    def chain_params(self):
+        return {'cutoff': self.request.get('cutoff')}
+
+    def query(self):
+        cutoff = datetime.strptime(self.request.get('cutoff'), CUTOFF_FORMAT)
+        return TriviaGame.query(TriviaGame.game_over == False,
+                                TriviaGame.last_activity < cutoff)
+
+    def process(self, games):
+        # Games that have not been started yet have nothing to remind about
+        games = [game for game in games if game.get_current_question()]
+        users = ndb.get_multi([game.user for game in games])
+        questions = Question.get_multi_cached(
+            [game.get_current_question() for game in games])
+
+        today = datetime.now().strftime('%Y%m%d')
+        tasks = {}
+        for game, user, question in zip(games, users, questions):
+            if user and user.email != None and question:
+                # Named per user and day, so the queue drops any second
+                # reminder for the same user that day
+                user_hash = hashlib.sha1(user.key.urlsafe()).hexdigest()
+                name = 'reminder-{}-{}'.format(user_hash, today)
+                if name in tasks:
+                    continue
+
+                body = TriviaApi._getPlayerReminder(game, user.name,
+                                                    question)
+                tasks[name] = taskqueue.Task(
+                    url='/tasks/send_mail', name=name,
+                    params={'to': user.email,
+                            'subject': 'A freindly reminder!',
+                            'body': body})
+
+        if tasks:
+            try:
+                taskqueue.Queue(MAIL_QUEUE).add(tasks.values())
+            except (taskqueue.TaskAlreadyExistsError,
+                    taskqueue.TombstonedTaskError):
+                # The remaining reminders were still added
+                pass
+
+
+class PurgeAbandonedGames(webapp2.RequestHandler):
+    def get(self):
+        """Start the purge of unfinished games idle for longer than the
+        given days. Called by a cron job"""
+        try:
+            days = int(self.request.get('days') or ABANDONED_GAME_DAYS)
+        except ValueError:
+            self.response.set_status(400)
+            return
+        cutoff = datetime.now() - timedelta(days=max(days, 1))
+        schedule_task('/tasks/purge_games',
+                      params={'cutoff': cutoff.strftime(CUTOFF_FORMAT)})
+
+
+class PurgeGames(CursorChainedTask):
+    """Deletes the unfinished games idle since the cutoff, a batch at a
+    time, with their legacy Turn entities in the same delete_multi."""
+    def chain_params(self):
+        return {'cutoff': self.request.get('cutoff')}
+
+    def query(self):
+        cutoff = datetime.strptime(self.request.get('cutoff'), CUTOFF_FORMAT)
+        return TriviaGame.query(TriviaGame.game_over == False,
+                                TriviaGame.last_activity < cutoff)
+
+    def process(self, games):
+        if games:
+            TriviaGame.delete_games(games)
+            logging.info('Purged %d abandoned games', len(games))
+
+
+class SendMail(webapp2.RequestHandler):
+    def post(self):
+        """Send one queued email. A failure returns an error status so the
+        mail queue retries it with backoff."""
         app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
-        games = TriviaGame.query(TriviaGame.game_over == False)
+        # This will send test emails, the arguments to send_mail are:
+        # from, to, subject, body
+        mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                       self.request.get('to'),
+                       self.request.get('subject'),
+                       self.request.get('body'))
+        self.response.set_status(204)
+
+
+class FlushGame(webapp2.RequestHandler):
+    def post(self):
+        """Write the cached state of a game to the datastore. Queued at most
+        once per flush window by requests that only update the game cache"""
+        TriviaGame.flush_cached(ndb.Key(urlsafe=self.request.get('game')))
+        self.response.set_status(204)
+
+
+class BackfillLastActivity(CursorChainedTask):
+    """Stamps the last activity time on games written before it was kept,
+    so the reminder pipeline can find them. Each game is re-read and written
+    through TriviaGame.update_stored, so a turn taken meanwhile is kept."""
+    def query(self):
+        return TriviaGame.query(TriviaGame.game_over == False)
+
+    @staticmethod
+    def stamp(game):
+        if game.last_activity is not None:
+            return False
+        game.touch()
+
+    def process(self, games):
         for game in games:
-            user = game.user.get()
-            if user.email != None:
-                subject = 'A freindly reminder!'
-                body = TriviaApi._getPlayerReminder(game, user.name)
-                # This will send test emails, the arguments to send_mail are:
-                # from, to, subject, body
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               user.email,
-                               subject,
-                               body)
+            if game.last_activity is None:
+                try:
+                    TriviaGame.update_stored(game.key, self.stamp)
+                except GameConflictError:
+                    # A turn was taken, which records the activity itself
+                    pass
 
 
 class UpdateAverageCorrectPerGame(webapp2.RequestHandler):
@@ -38,7 +231,310 @@ class UpdateAverageCorrectPerGame(webapp2.RequestHandler):
         self.response.set_status(204)
 
 
+class IndexQuestions(CursorChainedTask):
+    """Backfills the question catalogue with Questions created before it
+    existed."""
+    def query(self):
+        return Question.query()
+
+    def process(self, questions):
+        unindexed = [question for question in questions
+                     if question.seq is None]
+        if unindexed:
+            seqs = QuestionCatalogue.register([question.key
+                                               for question in unindexed])
+            for question, seq in zip(unindexed, seqs):
+                question.seq = seq
+            ndb.put_multi(unindexed)
+
+
+class RebuildQuestionPartition(CursorChainedTask):
+    """Rebuilds the catalogue of one category and/or difficulty partition
+    from the Questions in it. Used to backfill a partition after questions
+    were recategorized. The questions are registered again after the
+    current entries, which games keep drawing from until the last batch
+    drops them, so the catalogue is never partial and its version only
+    grows."""
+    def post(self):
+        try:
+            self.category = Question.normalize_category(
+                self.request.get('category'))
+            self.difficulty = Question.normalize_difficulty(
+                self.request.get('difficulty'))
+        except ValueError:
+            self.response.set_status(400)
+            return
+        if not self.category and not self.difficulty:
+            self.response.set_status(400)
+            return
+        if not self.request.get('cursor'):
+            QuestionCatalogue.start_rebuild(self.partition(), self.job_id())
+        super(RebuildQuestionPartition, self).post()
+
+    def partition(self):
+        return QuestionCatalogue.partition_id(self.category, self.difficulty)
+
+    def query(self):
+        query = Question.query()
+        if self.category:
+            query = query.filter(Question.category == self.category)
+        if self.difficulty:
+            query = query.filter(Question.difficulty == self.difficulty)
+        return query
+
+    def process(self, questions):
+        if questions:
+            QuestionCatalogue.register([question.key
+                                        for question in questions],
+                                       self.partition())
+
+    def finish(self):
+        QuestionCatalogue.finish_rebuild(self.partition(), self.job_id())
+
+    def chain_params(self):
+        return {'category': self.category or '',
+                'difficulty': self.difficulty or ''}
+
+
+class MigrateTurns(CursorChainedTask):
+    """Moves Turn entities into the TriviaGame and GameSummary that
+    reference them, then deletes them. Each game is re-read and written
+    through TriviaGame.update_stored, so a turn taken meanwhile is kept; a
+    game that changed during its update keeps its Turn entities until the
+    task runs again."""
+    def query(self):
+        return TriviaGame.query()
+
+    @staticmethod
+    def embed_turns(game):
+        if not game.turn_keys:
+            return False
+        game.embed_legacy_turns()
+        game.turn_keys = []
+
+    def process(self, games):
+        games = [game for game in games if game.turn_keys]
+        summaries = [GameSummary.query(GameSummary.trivia_game == game.key)
+                     .get_async() for game in games]
+        summaries = [summary.get_result() for summary in summaries]
+
+        turn_keys = []
+        migrated = []
+        for game, summary in zip(games, summaries):
+            try:
+                if not TriviaGame.update_stored(game.key, self.embed_turns):
+                    continue
+            except GameConflictError:
+                logging.info('Game %s changed, not migrated', game.key.id())
+                continue
+            turn_keys.extend(game.turn_keys)
+            if summary:
+                summary.embed_legacy_turns()
+                summary.turns = []
+                migrated.append(summary)
+
+        ndb.put_multi(migrated)
+        ndb.delete_multi(turn_keys)
+
+
+class BackfillSummaryTotals(CursorChainedTask):
+    """Stores the score, correct, incorrect and clue totals on GameSummaries
+    written before the totals were kept."""
+    def query(self):
+        return GameSummary.query()
+
+    def process(self, summaries):
+        summaries = [summary for summary in summaries
+                     if summary.correct is None]
+        for summary in summaries:
+            summary.set_totals()
+        ndb.put_multi(summaries)
+
+
+class BackfillScores(CursorChainedTask):
+    """Copies the user name onto Scores written before it was kept and
+    stores their ranking, which Score computes on every put."""
+    def query(self):
+        return Score.query()
+
+    def process(self, scores):
+        unnamed = [score for score in scores if not score.user_name]
+        users = ndb.get_multi([score.user for score in unnamed])
+        for score, user in zip(unnamed, users):
+            if user:
+                score.user_name = user.name
+        ndb.put_multi(scores)
+
+
+class BackfillUserKeys(CursorChainedTask):
+    """Lets users written before they were keyed by name be read by key.
+    Stores a UserName for each of them, and moves every Score that is not
+    keyed by its user onto the user's keyed Score. Once it has finished,
+    users and Scores are no longer looked up by query."""
+    BATCH_SIZE = 20
+
+    def query(self):
+        return User.query()
+
+    def process(self, users):
+        ndb.put_multi([UserName(id=user.name, user=user.key)
+                       for user in users if user.key.id() != user.name])
+
+        futures = [Score.legacy_keys_async(user.key) for user in users]
+        for user, future in zip(users, futures):
+            legacy_keys = future.get_result()
+            if legacy_keys:
+                Score.merge_legacy(user.key, legacy_keys)
+
+    def finish(self):
+        Migration.finish(USER_KEYS)
+
+
+class RebuildScoreHistogram(CursorChainedTask):
+    """Recounts the score histogram from every Score."""
+    def post(self):
+        if not self.request.get('cursor'):
+            ScoreHistogram.reset()
+        super(RebuildScoreHistogram, self).post()
+
+    def query(self):
+        return Score.query()
+
+    def process(self, scores):
+        if scores:
+            ScoreHistogram.add_scores([score.score for score in scores])
+
+
+class RebuildGameStats(CursorChainedTask):
+    """Recounts the GameStats totals from every GameSummary."""
+    def post(self):
+        if not self.request.get('cursor'):
+            GameStats.reset()
+        super(RebuildGameStats, self).post()
+
+    def query(self):
+        return GameSummary.query()
+
+    def process(self, summaries):
+        if summaries:
+            totals = [0, 0, 0, 0]
+            for summary in summaries:
+                totals = [x + y for x, y in zip(totals,
+                                                summary.aggregate_data())]
+            GameStats.record_game(*totals, games=len(summaries))
+
+
+class ImportQuestions(webapp2.RequestHandler):
+    """Imports questions from a JSONL or CSV file in Cloud Storage, one
+    batch per request. Each batch is validated, deduplicated by content
+    key and written with one put_multi, then the task re-enqueues itself
+    at the file offset where the batch ended. CSV files start with a header
+    row naming the QUESTION_FIELDS. A batch is registered in one
+    transaction that writes two entities per question, well under the limit
+    of 500."""
+    BATCH_SIZE = 200
+
+    def post(self):
+        path = self.request.get('path')
+        file_format = self.request.get('format')
+        offset = int(self.request.get('offset') or 0)
+        columns = self.request.get('columns')
+
+        reader = blobstore.BlobReader(blobstore.create_gs_key('/gs' + path))
+        reader.seek(offset)
+        if file_format == 'csv' and not columns:
+            columns = reader.readline().strip()
+
+        questions = []
+        skipped = 0
+        while len(questions) < self.BATCH_SIZE:
+            line_offset = reader.tell()
+            line = reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                questions.append(Question.from_row(
+                    self._parse(line, file_format, columns)))
+            except ValueError, e:
+                skipped += 1
+                logging.warning('Skipping question at offset %d of %s: %s',
+                                line_offset, path, e)
+
+        written = Question.import_questions(questions)
+        logging.info('Imported %d new questions from %s up to offset %d, '
+                     'skipped %d invalid rows', written, path, reader.tell(),
+                     skipped)
+
+        if line:
+            params = {'path': path, 'format': file_format,
+                      'offset': reader.tell(),
+                      'job': get_job_id(self.request)}
+            if columns:
+                params['columns'] = columns
+            schedule_task(self.request.path, window=None, params=params)
+        self.response.set_status(204)
+
+    @staticmethod
+    def _parse(line, file_format, columns):
+        """Returns the row a line of the file holds as a dict"""
+        if file_format == 'csv':
+            names = next(csv.reader([columns]))
+            values = [value.decode('utf-8')
+                      for value in next(csv.reader([line]))]
+            return dict(zip(names, values))
+
+        row = json.loads(line)
+        if not isinstance(row, dict):
+            raise ValueError('Row is not an object')
+        return row
+
+
+class QuestionCacheStats(webapp2.RequestHandler):
+    def get(self):
+        """Report the Question cache hit and miss counts of this instance."""
+        stats = Question.cache_stats()
+        logging.info('Question cache stats: %s', stats)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats))
+
+
+class EndpointStats(webapp2.RequestHandler):
+    def get(self):
+        """Report the latency and RPC counts per endpoint method and handler
+        recorded by this instance, over the last minutes (at most 15)."""
+        try:
+            minutes = int(self.request.get('minutes') or
+                          instrumentation.STATS_WINDOW_MINUTES)
+        except ValueError:
+            self.response.set_status(400)
+            return
+        minutes = max(1, min(minutes, instrumentation.STATS_WINDOW_MINUTES))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(instrumentation.get_stats(minutes),
+                                       sort_keys=True))
+
+
 app = webapp2.WSGIApplication([
     ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/send_reminders', SendReminders),
+    ('/tasks/send_mail', SendMail),
+    ('/crons/purge_games', PurgeAbandonedGames),
+    ('/tasks/purge_games', PurgeGames),
+    ('/tasks/flush_game', FlushGame),
+    ('/tasks/backfill_last_activity', BackfillLastActivity),
     ('/tasks/cache_average_correct_per_game', UpdateAverageCorrectPerGame),
+    ('/tasks/index_questions', IndexQuestions),
+    ('/tasks/import_questions', ImportQuestions),
+    ('/tasks/rebuild_question_partition', RebuildQuestionPartition),
+    ('/tasks/migrate_turns', MigrateTurns),
+    ('/tasks/backfill_summary_totals', BackfillSummaryTotals),
+    ('/tasks/backfill_scores', BackfillScores),
+    ('/tasks/backfill_user_keys', BackfillUserKeys),
+    ('/tasks/rebuild_score_histogram', RebuildScoreHistogram),
+    ('/tasks/rebuild_game_stats', RebuildGameStats),
+    ('/admin/question_cache', QuestionCacheStats),
+    ('/admin/endpoint_stats', EndpointStats),
 ], debug=True)
+app.router.set_dispatcher(instrumentation.dispatcher)
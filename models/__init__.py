@@ -1,9 +1,14 @@
-from .user import User
+from .user import User, UserName
 from .triviagame import TriviaGame, TriviaGameForm, TriviaGameForms, \
-     NewTriviaGameForm
-from .question import Question, QuestionForm, TriviaQuestionForm, ClueForm
-from .score import Score, ScoreForm, ScoreForms, DataForm, RankForm, RankForms
+     NewTriviaGameForm, GameConflictError
+from .question import Question, QuestionCatalogue, QuestionIndex, \
+     QuestionSeq, QuestionForm, TriviaQuestionForm, ClueForm
+from .score import Score, ScoreHistogram, ScoreForm, ScoreForms, DataForm, \
+     RankForm, RankForms, UserRankForm
 from .gamesummary import GameSummary, GameSummaryForm, GameSummaryForms, \
      GameDetailForm, GameDetailForms
-from .turn import Turn
+from .turn import Turn, TurnRecord
+from .gamestats import GameStats
+from .turntoken import TurnToken, TurnTokenSecret
+from .migration import Migration, USER_KEYS
 from .stringmessage import StringMessage
@@ -0,0 +1,68 @@
+"""gamestats.py - This file contains the class definitions for the Datastore
+entity GameStats. Each entity is one shard of the running totals over every
+finished game; 'record_game' adds a game to a shard and 'get_totals' sums
+the shards."""
+
+import random
+from google.appengine.ext import ndb
+
+GAME_STATS_SHARDS = 20
+
+
+class GameStats(ndb.Model):
+    """GameStats object"""
+    games_finished = ndb.IntegerProperty(default=0, indexed=False)
+    total_correct = ndb.IntegerProperty(default=0, indexed=False)
+    total_incorrect = ndb.IntegerProperty(default=0, indexed=False)
+    total_clues_used = ndb.IntegerProperty(default=0, indexed=False)
+    total_points = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def _shard_keys(cls):
+        return [ndb.Key(cls, shard + 1)
+                for shard in range(GAME_STATS_SHARDS)]
+
+    @classmethod
+    def record_game(cls, points, correct, incorrect, clues_used, games=1):
+        """Adds finished games to a randomly chosen shard"""
+        shard_key = random.choice(cls._shard_keys())
+
+        @ndb.transactional
+        def txn():
+            shard = shard_key.get() or cls(key=shard_key)
+            shard.games_finished += games
+            shard.total_points += points
+            shard.total_correct += correct
+            shard.total_incorrect += incorrect
+            shard.total_clues_used += clues_used
+            shard.put()
+        txn()
+
+    @classmethod
+    def reset(cls):
+        ndb.delete_multi(cls._shard_keys())
+
+    @classmethod
+    def get_totals(cls):
+        """Returns an unsaved GameStats holding the sum of all shards"""
+        totals = cls()
+        for shard in ndb.get_multi(cls._shard_keys()):
+            if shard:
+                totals.games_finished += shard.games_finished
+                totals.total_points += shard.total_points
+                totals.total_correct += shard.total_correct
+                totals.total_incorrect += shard.total_incorrect
+                totals.total_clues_used += shard.total_clues_used
+        return totals
+
+    def average_correct(self):
+        """Returns the average number of correct answers per game"""
+        if not self.games_finished:
+            return 0.0
+        return float(self.total_correct) / self.games_finished
+
+    def average_clues_used(self):
+        """Returns the average number of clues used per game"""
+        if not self.games_finished:
+            return 0.0
+        return float(self.total_clues_used) / self.games_finished
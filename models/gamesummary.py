@@ -1,11 +1,14 @@
 """GameSummary.py - This file contains the class definitions for the Datastore
-entity GameSummary. This classes also includes methods 'new_game_summary', 
-'to_summary_form', 'to_detail_form' and 'aggregate_data'."""
+entity GameSummary. This classes also includes methods 'new_game_summary',
+'to_summary_form', 'to_detail_form', 'to_detail_forms', 'aggregate_data',
+'set_totals', 'get_turns' and 'embed_legacy_turns'."""
 
 import random
 from datetime import date
 from protorpc import messages
 from google.appengine.ext import ndb
+from question import Question
+from turn import TurnRecord
 
 
 class GameSummary(ndb.Model):
@@ -13,42 +16,92 @@ class GameSummary(ndb.Model):
     user = ndb.KeyProperty(required=True, kind='User')
     trivia_game = ndb.KeyProperty(required=True, kind='TriviaGame')
     date = ndb.DateProperty(required=True)
+    turn_records = ndb.LocalStructuredProperty(TurnRecord, repeated=True,
+                                               compressed=True)
+    # Turns stored as separate Turn entities by earlier versions
     turns = ndb.KeyProperty(kind='Turn', repeated=True)
     score = ndb.IntegerProperty(required=True)
+    # Totals stored when the game ends, missing on older summaries
+    correct = ndb.IntegerProperty()
+    incorrect = ndb.IntegerProperty()
+    clues_used = ndb.IntegerProperty()
 
     @classmethod
     def new_game_summary(cls, user, game, date, turns):
-        """Creates and returns a new game summary"""
-
-        total_score = 0
-        for turn in turns:
-            total_score += turn.get().points
-
+        """Creates and returns a new game summary from the TurnRecords of
+        the game, with its totals stored"""
         game_summary = GameSummary(user=user,
                                    trivia_game=game,
                                    date=date,
-                                   turns=turns,
-                                   score=total_score)
+                                   turn_records=turns)
+        game_summary.set_totals()
         game_summary.put()
         return game_summary
 
-    def to_summary_form(self):
+    def get_turns(self):
+        """Returns the TurnRecords of the summarised game"""
+        self.embed_legacy_turns()
+        return self.turn_records
+
+    def embed_legacy_turns(self, turns=None):
+        """Copies turns stored as separate Turn entities into the summary.
+        The Turn entities are fetched unless they are passed in"""
+        if self.turns and not self.turn_records:
+            if turns is None:
+                turns = ndb.get_multi(self.turns)
+            self.turn_records = [TurnRecord.from_turn(turn)
+                                 for turn in turns if turn]
+
+    def to_summary_form(self, user_name=None):
         (score, numCorrect, numIncorrect, clues_used) = self.aggregate_data()
 
-        return GameSummaryForm(user_name=self.user.get().name,
+        return GameSummaryForm(user_name=user_name or self.user.get().name,
                                date=str(self.date),
-                               questions_answered=len(self.turns),
+                               questions_answered=numCorrect + numIncorrect,
                                correct=numCorrect,
                                incorrect=numIncorrect,
                                clues_used=clues_used,
                                total_score=score)
 
     def to_detail_form(self):
+        return GameSummary.to_detail_forms([self])
+
+    @classmethod
+    def to_detail_forms(cls, summaries):
+        """Returns the GameDetailForms for every turn of the summaries. Any
+        legacy Turn entities and then the questions asked are each resolved
+        with one batched get for the whole list"""
+        legacy = [summary for summary in summaries
+                  if summary.turns and not summary.turn_records]
+        if legacy:
+            futures = ndb.get_multi_async([key for summary in legacy
+                                           for key in summary.turns])
+            for summary in legacy:
+                turns = [future.get_result()
+                         for future in futures[:len(summary.turns)]]
+                futures = futures[len(summary.turns):]
+                summary.embed_legacy_turns(turns)
+
+        question_keys = [turn.question_key for summary in summaries
+                         for turn in summary.turn_records]
+        questions = dict(zip(question_keys,
+                             Question.get_multi_cached(question_keys)))
+
+        detailForms = []
+        for summary in summaries:
+            detailForms.extend(summary._turn_detail_forms(questions))
+
+        return detailForms
+
+    def _turn_detail_forms(self, questions):
         detailForms = []
 
-        for turn_key in self.turns:
-            turn = turn_key.get()
-            question_asked = turn.question_key.get().question
+        for turn in self.turn_records:
+            question = questions.get(turn.question_key)
+            if question:
+                question_asked = question.question
+            else:
+                question_asked = 'Question no longer available'
             answer_given = turn.given_answer
             clues_used = turn.clues_used
             if turn.is_correct:
@@ -67,7 +120,16 @@ class GameSummary(ndb.Model):
         return detailForms
 
     def aggregate_data(self):
-        gameTurns = ndb.get_multi(self.turns)
+        """Returns the stored score, correct, incorrect and clue totals"""
+        if self.correct is None:
+            self.set_totals()
+
+        return [self.score, self.correct, self.incorrect, self.clues_used]
+
+    def set_totals(self):
+        """Computes the totals over the turns of the game and stores them on
+        the summary. The caller writes the summary"""
+        gameTurns = self.get_turns()
         score = 0
         numCorrect = 0
         numIncorrect = 0
@@ -80,7 +142,10 @@ class GameSummary(ndb.Model):
             else:
                 numIncorrect += 1
 
-        return [score, numCorrect, numIncorrect, clues_used]
+        self.score = score
+        self.correct = numCorrect
+        self.incorrect = numIncorrect
+        self.clues_used = clues_used
 
 
 class GameSummaryForm(messages.Message):
@@ -97,6 +162,7 @@ class GameSummaryForm(messages.Message):
 class GameSummaryForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(GameSummaryForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
 
 
 class GameDetailForm(messages.Message):
@@ -117,4 +183,5 @@ class GameDetailForms(messages.Message):
     total_incorrect = messages.IntegerField(4, required=True, default=0)
     total_clues_used = messages.IntegerField(5, required=True, default=0)
     total_points = messages.IntegerField(6, required=True, default=0)
+    next_page_token = messages.StringField(7)
 
@@ -0,0 +1,74 @@
+"""lrucache.py - This file contains the class definitions for LRUCache, a
+bounded, thread safe, in-process least recently used cache, and HitCounter
+which keeps the hit and miss counts used to size it."""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class HitCounter(object):
+    """Thread safe hit and miss counter"""
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def record(self, hits=0, misses=0):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def stats(self):
+        """Returns the counts and the hit ratio as a dict"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            ratio = float(self.hits) / lookups if lookups else 0.0
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_ratio': round(ratio, 4)}
+
+
+class LRUCache(object):
+    """Least recently used cache holding at most max_size entries, each of
+    which expires ttl seconds after it was set"""
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.counter = HitCounter()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value for key or None"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[1] > time.time():
+                # Re-insert to mark the entry as most recently used
+                self._entries[key] = entry
+                value = entry[0]
+            else:
+                value = None
+
+        if value is None:
+            self.counter.record(misses=1)
+        else:
+            self.counter.record(hits=1)
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + self.ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        """Returns the size and hit counts of the cache as a dict"""
+        stats = self.counter.stats()
+        stats['size'] = len(self._entries)
+        stats['max_size'] = self.max_size
+        return stats
@@ -0,0 +1,31 @@
+"""migration.py - This file contains the class definition for the Datastore
+entity Migration. A Migration is written when a backfill task finishes, so
+the code can stop falling back to the layout the backfill replaced;
+'is_finished' checks for one and 'finish' records one."""
+
+from google.appengine.ext import ndb
+
+# Id of the Migration written by the BackfillUserKeys task
+USER_KEYS = 'user_keys'
+
+_finished = set()
+
+
+class Migration(ndb.Model):
+    """Migration object. Its id names a backfill, and it exists once the
+    backfill has finished"""
+    finished = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+    @classmethod
+    def is_finished(cls, name):
+        """Returns True once the backfill has finished, kept in memory once
+        seen"""
+        if name not in _finished and cls.get_by_id(name):
+            _finished.add(name)
+        return name in _finished
+
+    @classmethod
+    def finish(cls, name):
+        """Records that the backfill has finished"""
+        cls(id=name).put()
+        _finished.add(name)
@@ -1,11 +1,41 @@
 """Question.py - This file contains the class definitions for the Datastore
 entity Question. Because these classes are also regular Python
-classes they can include methods (such as 'to_form' and 'new_game')."""
+classes they can include methods (such as 'to_form' and 'new_game').
+QuestionCatalogue and QuestionIndex number every question densely so a
+question can be picked at random with a get by key. Each category and
+difficulty partition keeps a catalogue of its own."""
 
+import hashlib
 import random
+from collections import OrderedDict
 from datetime import date
 from protorpc import messages
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
+from lrucache import LRUCache, HitCounter
+
+# Fields of a question, as given to create_question or in an import file
+QUESTION_FIELDS = ('question', 'correct', 'wrong1', 'wrong2', 'wrong3',
+                   'clue1', 'clue2')
+
+# Id of the QuestionCatalogue holding every question
+ALL_QUESTIONS = 'all'
+
+# Difficulty tiers a question can be given
+DIFFICULTIES = ('easy', 'medium', 'hard')
+
+# Auto-allocated Question ids are scattered over this range, so probing the
+# key index at random ids gives a cheap random sample of the catalogue.
+MAX_SCATTERED_ID = 2 ** 52
+
+# Questions rarely change, so each instance keeps recently used ones in
+# memory. The ttl bounds how long an edit takes to reach other instances.
+QUESTION_CACHE_SIZE = 1000
+QUESTION_CACHE_TTL = 600
+MEMCACHE_QUESTION_PREFIX = 'question:'
+
+_question_cache = LRUCache(QUESTION_CACHE_SIZE, QUESTION_CACHE_TTL)
+_question_memcache_counter = HitCounter()
 
 
 class Question(ndb.Model):
@@ -14,28 +44,271 @@ class Question(ndb.Model):
     question = ndb.TextProperty(required=True)
     answers = ndb.JsonProperty(required=True)
     clues = ndb.TextProperty(repeated=True)
+    seq = ndb.IntegerProperty(indexed=False)
+    category = ndb.StringProperty()
+    difficulty = ndb.StringProperty(choices=DIFFICULTIES)
+
+    # get_cached manages memcache for Questions itself
+    _use_memcache = False
 
     @classmethod
-    def new_question(cls, quest, ans, hints):
-        """Creates and returns a new question"""
-        triviaQuestion = Question(question=quest,
+    @ndb.transactional(xg=True)
+    def new_question(cls, quest, ans, hints, category=None, difficulty=None):
+        """Creates and returns a new question, registered in the catalogue
+        index of every partition it belongs to so it can be picked at random.
+        Questions are keyed by their content, so an identical question is
+        returned instead of being created twice"""
+        key = cls.content_key(quest, ans)
+        existing = key.get()
+        if existing:
+            return existing
+
+        triviaQuestion = Question(key=key,
+                                  question=quest,
                                   answers=ans,
-                                  clues=hints)
+                                  clues=hints,
+                                  category=category,
+                                  difficulty=difficulty)
+        for partition in triviaQuestion.partitions():
+            (seq,) = QuestionCatalogue.register([key], partition)
+            if partition == ALL_QUESTIONS:
+                triviaQuestion.seq = seq
+        # Nothing can be cached for a key that did not exist
+        triviaQuestion._is_new = True
         triviaQuestion.put()
         return triviaQuestion
 
+    @staticmethod
+    def normalize_category(category):
+        """Returns the stored form of a category, or None if it is blank"""
+        if category and category.strip():
+            return u' '.join(category.lower().split())
+        return None
+
+    @staticmethod
+    def normalize_difficulty(difficulty):
+        """Returns the stored form of a difficulty, or None if it is blank.
+        Raises ValueError if it is not one of the DIFFICULTIES"""
+        if not difficulty or not difficulty.strip():
+            return None
+        difficulty = difficulty.strip().lower()
+        if difficulty not in DIFFICULTIES:
+            raise ValueError('Difficulty must be one of {}'.format(
+                ', '.join(DIFFICULTIES)))
+        return difficulty
+
+    def partitions(self):
+        """Returns the ids of the QuestionCatalogues the question belongs to"""
+        partitions = [ALL_QUESTIONS]
+        if self.category:
+            partitions.append(QuestionCatalogue.partition_id(
+                category=self.category))
+        if self.difficulty:
+            partitions.append(QuestionCatalogue.partition_id(
+                difficulty=self.difficulty))
+        if self.category and self.difficulty:
+            partitions.append(QuestionCatalogue.partition_id(
+                self.category, self.difficulty))
+        return partitions
+
+    @staticmethod
+    def content_key(quest, ans):
+        """Returns the key for a question, a hash of its text and answers
+        ignoring case, spacing and the order of the wrong answers"""
+        def normalize(text):
+            return u' '.join(text.lower().split())
+
+        wrong = sorted(normalize(value) for name, value in ans.items()
+                       if name != 'correct')
+        content = u'\n'.join([normalize(quest), normalize(ans['correct'])] +
+                              wrong)
+        return ndb.Key(Question,
+                       hashlib.sha1(content.encode('utf-8')).hexdigest())
+
+    @classmethod
+    def from_row(cls, row):
+        """Returns an unsaved Question built from a dict holding the
+        QUESTION_FIELDS and, optionally, a category and a difficulty. Raises
+        ValueError if a field is missing or empty or the difficulty is not
+        one of the DIFFICULTIES"""
+        values = {}
+        for field in QUESTION_FIELDS:
+            value = row.get(field)
+            if not isinstance(value, basestring) or not value.strip():
+                raise ValueError('Missing {}'.format(field))
+            values[field] = value.strip()
+
+        answers = {'correct': values['correct'],
+                   'wrong1': values['wrong1'],
+                   'wrong2': values['wrong2'],
+                   'wrong3': values['wrong3']}
+        question = cls(key=cls.content_key(values['question'], answers),
+                       question=values['question'],
+                       answers=answers,
+                       clues=[values['clue1'], values['clue2']],
+                       category=cls.normalize_category(row.get('category')),
+                       difficulty=cls.normalize_difficulty(
+                           row.get('difficulty')))
+        question._is_new = True
+        return question
+
+    @classmethod
+    def import_questions(cls, questions):
+        """Writes the unsaved questions whose keys do not exist yet. They
+        are registered in the catalogue of each partition with one
+        transaction per partition and written with one put_multi. Returns the
+        number of questions written"""
+        unique = OrderedDict((question.key, question)
+                             for question in questions)
+        existing = ndb.get_multi(unique.keys())
+        new = [question for question, found in zip(unique.values(), existing)
+               if not found]
+
+        if new:
+            partitions = OrderedDict()
+            for question in new:
+                for partition in question.partitions():
+                    partitions.setdefault(partition, []).append(question)
+            for partition, members in partitions.items():
+                seqs = QuestionCatalogue.register(
+                    [question.key for question in members], partition)
+                if partition == ALL_QUESTIONS:
+                    for question, seq in zip(members, seqs):
+                        question.seq = seq
+            ndb.put_multi(new)
+        return len(new)
+
+    @classmethod
+    def get_cached(cls, key):
+        """Returns the Question for key or None if it does not exist"""
+        return cls.get_multi_cached([key])[0]
+
+    @classmethod
+    def get_multi_cached(cls, keys):
+        """Returns the Questions for keys in order"""
+        return cls.get_multi_cached_async(keys).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_multi_cached_async(cls, keys):
+        """Tasklet returning the Questions for keys in order, reading through
+        the instance cache and memcache before the datastore. The returned
+        entities are shared between requests and must not be modified"""
+        found = {}
+        keys_wanted = set(key for key in keys if key)
+        for key in keys_wanted:
+            question = _question_cache.get(key)
+            if question:
+                found[key] = question
+
+        missing = [key for key in keys_wanted if key not in found]
+        if missing:
+            ctx = ndb.get_context()
+            cached = yield [ctx.memcache_get(MEMCACHE_QUESTION_PREFIX +
+                                             key.urlsafe())
+                            for key in missing]
+            cached = dict((key, question)
+                          for key, question in zip(missing, cached)
+                          if question)
+            _question_memcache_counter.record(
+                hits=len(cached), misses=len(missing) - len(cached))
+
+            unresolved = [key for key in missing if key not in cached]
+            fetched = {}
+            if unresolved:
+                questions = yield ndb.get_multi_async(unresolved)
+                fetched = dict((key, question)
+                               for key, question in zip(unresolved, questions)
+                               if question)
+                yield [ctx.memcache_set(MEMCACHE_QUESTION_PREFIX +
+                                        key.urlsafe(), question)
+                       for key, question in fetched.items()]
+
+            for key in missing:
+                question = cached.get(key) or fetched.get(key)
+                if question:
+                    _question_cache.set(key, question)
+                    found[key] = question
+
+        raise ndb.Return([found.get(key) for key in keys])
+
+    @classmethod
+    def invalidate_cache(cls, key):
+        """Drops the Question for key from the instance cache and memcache"""
+        _question_cache.delete(key)
+        memcache.delete(MEMCACHE_QUESTION_PREFIX + key.urlsafe())
+
+    @classmethod
+    def cache_stats(cls):
+        """Returns the hit and miss counts of both cache layers"""
+        return {'instance': _question_cache.stats(),
+                'memcache': _question_memcache_counter.stats()}
+
+    def _post_put_hook(self, future):
+        if getattr(self, '_is_new', False):
+            self._is_new = False
+        else:
+            Question.invalidate_cache(self.key)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        cls.invalidate_cache(key)
+
+    @classmethod
+    def sample_keys(cls, count, partition=ALL_QUESTIONS):
+        """Returns up to count distinct Question keys picked uniformly at
+        random from a partition. Sequence numbers are drawn from its
+        catalogue and resolved with a single batched get, so the cost does
+        not depend on the size of the catalogue"""
+        first, last = QuestionCatalogue.get_range(partition)
+        size = last - first + 1
+        if size <= 0:
+            if partition == ALL_QUESTIONS:
+                # Catalogue not yet backfilled, fall back to probing the keys
+                return cls._probe_keys(count)
+            return []
+
+        seqs = random.sample(xrange(first, last + 1), min(count, size))
+        entries = ndb.get_multi([QuestionIndex.key_for(seq, partition)
+                                 for seq in seqs])
+        return [entry.question for entry in entries if entry]
+
+    @classmethod
+    def _probe_keys(cls, count):
+        """Returns up to count distinct Question keys picked at random. Each
+        key comes from a keys-only probe of the key index"""
+        probes = []
+        for i in range(count):
+            start = ndb.Key(cls, random.randint(1, MAX_SCATTERED_ID))
+            probes.append(cls.query(cls.key >= start).fetch_async(
+                1, keys_only=True))
+
+        keys = []
+        for probe in probes:
+            for key in probe.get_result():
+                if key not in keys:
+                    keys.append(key)
+
+        if len(keys) < count:
+            # Probes past the last key wrap around to the start of the index
+            for key in cls.query().fetch(count, keys_only=True):
+                if key not in keys and len(keys) < count:
+                    keys.append(key)
+
+        return keys
+
     def to_form(self):
         """Returns a QuestionForm representation of the Question"""
         form = QuestionForm()
         form.question = self.question
 
-        ansDict = self.answers
+        ansDict = dict(self.answers)
         form.correct = ansDict.pop('correct')
         (form.wrong1, form.wrong2, form.wrong3) = ansDict.values()
 
-        clueDict = self.clues
-
         (form.clue1, form.clue2) = self.clues
+        form.category = self.category
+        form.difficulty = self.difficulty
         return form
 
     def to_trivia_form(self):
@@ -53,7 +326,7 @@ class Question(ndb.Model):
 
     def is_correct_answer(self, answer):
         """Returns a boolean if the supplied answer is correct"""
-        correctAnswer = self.answers.pop('correct')
+        correctAnswer = self.answers.get('correct')
 
         if answer == correctAnswer:
             return True
@@ -61,6 +334,146 @@ class Question(ndb.Model):
         return False
 
 
+class QuestionCatalogue(ndb.Model):
+    """QuestionCatalogue object. Counts the questions that have been given a
+    dense sequence number; its QuestionIndex children map each number back
+    to a Question key. The catalogue with id ALL_QUESTIONS holds every
+    question, the others the questions of one category, difficulty or
+    category and difficulty partition. The count only grows and is the
+    version of the catalogue; a rebuild drops the entries before first"""
+    count = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    first = ndb.IntegerProperty(required=True, default=1, indexed=False)
+    # Set while a rebuild registers the questions again after the entries
+    # it will replace, from this sequence number on
+    rebuild_from = ndb.IntegerProperty(indexed=False)
+    rebuild_job = ndb.StringProperty(indexed=False)
+
+    @staticmethod
+    def partition_id(category=None, difficulty=None):
+        """Returns the catalogue id of a partition, ALL_QUESTIONS when
+        neither a category nor a difficulty is given"""
+        parts = []
+        if category:
+            parts.append(u'category=' + category)
+        if difficulty:
+            parts.append(u'difficulty=' + difficulty)
+        return u'/'.join(parts) or ALL_QUESTIONS
+
+    @classmethod
+    def get_size(cls, partition=ALL_QUESTIONS):
+        """Returns the number of questions in the catalogue"""
+        catalogue = cls.get_by_id(partition)
+        if catalogue:
+            return catalogue.count
+        return 0
+
+    @classmethod
+    def get_range(cls, partition=ALL_QUESTIONS):
+        """Returns the first and last sequence numbers questions are drawn
+        from. While a rebuild runs they are the entries it will replace,
+        which stay complete until it finishes"""
+        catalogue = cls.get_by_id(partition)
+        if not catalogue:
+            return 1, 0
+        if catalogue.rebuild_from:
+            return catalogue.first, catalogue.rebuild_from - 1
+        return catalogue.first, catalogue.count
+
+    def _current_from(self):
+        """Returns the first sequence number of the entries registration
+        keeps, those of the rebuild while one runs"""
+        return self.rebuild_from or self.first
+
+    @classmethod
+    @ndb.transactional
+    def start_rebuild(cls, partition, job):
+        """Starts registering the questions of a partition again after its
+        current entries. Starting the same job again does nothing, so a
+        retried first batch does not drop the batches registered since"""
+        catalogue = cls.get_by_id(partition) or cls(id=partition)
+        if catalogue.rebuild_job != job:
+            catalogue.rebuild_from = catalogue.count + 1
+            catalogue.rebuild_job = job
+            catalogue.put()
+
+    @classmethod
+    @ndb.transactional
+    def finish_rebuild(cls, partition, job):
+        """Drops the entries registered before the rebuild job started.
+        The count is kept, so the catalogue version never goes backwards"""
+        catalogue = cls.get_by_id(partition)
+        if catalogue and catalogue.rebuild_job == job:
+            catalogue.first = catalogue.rebuild_from
+            catalogue.rebuild_from = None
+            catalogue.rebuild_job = None
+            catalogue.put()
+
+    @classmethod
+    def keys_since(cls, version, limit, partition=ALL_QUESTIONS):
+        """Returns the keys of the questions registered after version, the
+        newest limit of them at most, and the current version. The count of
+        the catalogue is its version and the QuestionIndex entries past a
+        version are the questions added since, so nothing is read beyond the
+        catalogue when no question was added"""
+        catalogue = cls.get_by_id(partition)
+        current = catalogue.count if catalogue else 0
+        if current <= version:
+            return [], current
+
+        first = max(version + 1, current - limit + 1, catalogue.first)
+        entries = ndb.get_multi([QuestionIndex.key_for(seq, partition)
+                                 for seq in xrange(first, current + 1)])
+        return [entry.question for entry in entries if entry], current
+
+    @classmethod
+    @ndb.transactional
+    def register(cls, question_keys, partition=ALL_QUESTIONS):
+        """Appends the question keys to the catalogue of a partition and
+        returns the sequence numbers assigned to them. Keys already in the
+        catalogue keep their number, so registering again after a failed
+        write of the Questions does not index them twice. Keys whose number
+        is before the entries being kept are registered again"""
+        catalogue = cls.get_by_id(partition) or cls(id=partition)
+        known = ndb.get_multi([QuestionSeq.key_for(key, partition)
+                               for key in question_keys])
+
+        seqs = []
+        entries = []
+        for key, seq_entry in zip(question_keys, known):
+            if seq_entry and seq_entry.seq >= catalogue._current_from():
+                seqs.append(seq_entry.seq)
+                continue
+            catalogue.count += 1
+            seqs.append(catalogue.count)
+            entries.append(QuestionIndex(parent=catalogue.key,
+                                         id=catalogue.count, question=key))
+            entries.append(QuestionSeq(parent=catalogue.key, id=key.id(),
+                                       seq=catalogue.count))
+        if entries:
+            ndb.put_multi([catalogue] + entries)
+        return seqs
+
+
+class QuestionIndex(ndb.Model):
+    """QuestionIndex object. Its id is the sequence number of the question"""
+    question = ndb.KeyProperty(required=True, kind='Question', indexed=False)
+
+    @staticmethod
+    def key_for(seq, partition=ALL_QUESTIONS):
+        return ndb.Key(QuestionCatalogue, partition, QuestionIndex, seq)
+
+
+class QuestionSeq(ndb.Model):
+    """QuestionSeq object. The reverse of QuestionIndex: its id is the id
+    of a Question and it holds the question's sequence number"""
+    seq = ndb.IntegerProperty(required=True, indexed=False)
+
+    @staticmethod
+    def key_for(question_key, partition=ALL_QUESTIONS):
+        return ndb.Key(QuestionCatalogue, partition, QuestionSeq,
+                       question_key.id())
+
+
 class QuestionForm(messages.Message):
     """QuestionForm for Question information"""
     question = messages.StringField(1, required=True)
@@ -70,6 +483,8 @@ class QuestionForm(messages.Message):
     wrong3 = messages.StringField(5, required=True)
     clue1 = messages.StringField(6, required=True)
     clue2 = messages.StringField(7, required=True)
+    category = messages.StringField(8)
+    difficulty = messages.StringField(9)
 
 
 class TriviaQuestionForm(messages.Message):
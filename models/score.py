@@ -1,32 +1,221 @@
 """Score.py - This file contains the class definitions for the Datastore
-entity Score. This class also includes methods 'to_data_form' and
-'to_score_form'."""
+entity Score. Each user's Score is keyed by the user's id, so it is read by
+key. This class also includes methods 'key_for', 'get_for_user',
+'legacy_keys_async', 'merge_legacy', 'compute_ranking', 'get_user_name',
+'to_data_form', 'to_rank_form' and 'to_score_form'. ScoreHistogram keeps the
+number of players per score bucket so a player's rank can be looked up
+without reading other players' Scores."""
 
 import random
 from datetime import date
 from protorpc import messages
 from google.appengine.ext import ndb
+from migration import Migration, USER_KEYS
+
+# Scores are counted in buckets of this width, the last bucket holds every
+# score above SCORE_BUCKET_WIDTH * (SCORE_BUCKETS - 1)
+SCORE_BUCKET_WIDTH = 10
+SCORE_BUCKETS = 1000
+# Histogram updates are spread over this many entities
+SCORE_HISTOGRAM_SHARDS = 20
 
 
 class Score(ndb.Model):
     """Score object"""
     user = ndb.KeyProperty(required=True, kind='User')
+    # Copy of User.name so leaderboards need no User reads
+    user_name = ndb.StringProperty(indexed=False)
     score = ndb.IntegerProperty(required=True, default=0)
     num_correct = ndb.IntegerProperty(required=True, default=0)
     num_incorrect = ndb.IntegerProperty(required=True, default=0)
     clues_used = ndb.IntegerProperty(required=True, default=0)
+    # Recomputed from the counts above whenever the Score is written
+    ranking = ndb.FloatProperty()
+
+    @staticmethod
+    def key_for(user_key):
+        """Returns the key of a user's Score, which shares the user's id"""
+        return ndb.Key(Score, user_key.id())
+
+    @classmethod
+    def get_for_user(cls, user_key):
+        """Returns the user's Score or None. Until the BackfillUserKeys task
+        has finished, a Score not yet keyed by its user is found by query"""
+        score = cls.key_for(user_key).get()
+        if score is None and not Migration.is_finished(USER_KEYS):
+            score = cls.query(cls.user == user_key).get()
+        return score
+
+    @classmethod
+    @ndb.tasklet
+    def legacy_keys_async(cls, user_key):
+        """Tasklet returning the keys of the user's Scores written before
+        Scores were keyed by their user"""
+        keys = yield cls.query(cls.user == user_key).fetch_async(
+            keys_only=True)
+        score_key = cls.key_for(user_key)
+        raise ndb.Return([key for key in keys if key != score_key])
+
+    @classmethod
+    def merge_legacy(cls, user_key, legacy_keys):
+        """Adds the totals of the legacy Scores to the user's keyed Score
+        and deletes them, moving the player in the score histogram"""
+        old_scores, score = cls._merge_legacy(user_key, legacy_keys)
+        if old_scores:
+            counts = [0] * SCORE_BUCKETS
+            for old_score in old_scores:
+                counts[ScoreHistogram.bucket_for(old_score)] -= 1
+            counts[ScoreHistogram.bucket_for(score.score)] += 1
+            ScoreHistogram.add_counts(counts)
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _merge_legacy(cls, user_key, legacy_keys):
+        entities = ndb.get_multi([cls.key_for(user_key)] + legacy_keys)
+        legacy = [entity for entity in entities[1:] if entity]
+        if not legacy:
+            return [], entities[0]
+
+        score = entities[0]
+        old_scores = [entity.score for entity in legacy]
+        if score:
+            old_scores.append(score.score)
+        else:
+            score = cls(key=cls.key_for(user_key), user=user_key,
+                        user_name=legacy[0].user_name)
+        for entity in legacy:
+            score.score += entity.score
+            score.num_correct += entity.num_correct
+            score.num_incorrect += entity.num_incorrect
+            score.clues_used += entity.clues_used
+        score.put()
+        ndb.delete_multi([entity.key for entity in legacy])
+        return old_scores, score
+
+    def compute_ranking(self):
+        """Returns 10 * (score * correct answers/total questions) - clues
+        used, the value players are ranked by"""
+        answered = self.num_correct + self.num_incorrect
+        if answered == 0:
+            return 0.0
+
+        factor = self.num_correct/float(answered)
+        return round(10 * self.score * factor) - self.clues_used
+
+    def _pre_put_hook(self):
+        self.ranking = self.compute_ranking()
+
+    def get_user_name(self):
+        """Returns the stored user name, falling back to the User entity
+        for Scores written before the name was kept"""
+        if not self.user_name:
+            self.user_name = self.user.get().name
+        return self.user_name
 
     def to_data_form(self):
-        return DataForm(user_name=self.user.get().name, score=self.score,
+        return DataForm(user_name=self.get_user_name(), score=self.score,
                         correct_ans=self.num_correct,
                         incorrect_ans=self.num_incorrect,
                         clues_used=self.clues_used)
 
+    def to_rank_form(self):
+        """Returns a UserRankForm with the rank of this Score"""
+        rank, total, exact = ScoreHistogram.get_rank(self.score)
+        percentile = 100.0 * (total - rank + 1) / total
+        return UserRankForm(user_name=self.get_user_name(),
+                            score=self.score,
+                            rank=rank,
+                            total_players=total,
+                            percentile=round(percentile, 2),
+                            exact=exact)
+
     def to_score_form(self):
-        return ScoreForm(user_name=self.user.get().name,
+        return ScoreForm(user_name=self.get_user_name(),
                          score=self.score)
 
 
+class ScoreHistogram(ndb.Model):
+    """ScoreHistogram object. One shard of the player count per score
+    bucket, the shards are summed when the histogram is read"""
+    counts = ndb.IntegerProperty(repeated=True, indexed=False)
+
+    @staticmethod
+    def bucket_for(score):
+        return min(max(score, 0) // SCORE_BUCKET_WIDTH, SCORE_BUCKETS - 1)
+
+    @classmethod
+    def _shard_keys(cls):
+        return [ndb.Key(cls, shard + 1)
+                for shard in range(SCORE_HISTOGRAM_SHARDS)]
+
+    @classmethod
+    def move(cls, old_score, new_score):
+        """Moves a player from the bucket of old_score to the bucket of
+        new_score. old_score is None for a new player"""
+        counts = [0] * SCORE_BUCKETS
+        if old_score is not None:
+            counts[cls.bucket_for(old_score)] -= 1
+        counts[cls.bucket_for(new_score)] += 1
+        cls.add_counts(counts)
+
+    @classmethod
+    def add_scores(cls, scores):
+        """Counts a player for each of the scores"""
+        counts = [0] * SCORE_BUCKETS
+        for score in scores:
+            counts[cls.bucket_for(score)] += 1
+        cls.add_counts(counts)
+
+    @classmethod
+    def add_counts(cls, counts):
+        """Adds the per bucket counts to a randomly chosen shard"""
+        shard_key = random.choice(cls._shard_keys())
+
+        @ndb.transactional
+        def txn():
+            shard = shard_key.get() or cls(key=shard_key,
+                                           counts=[0] * SCORE_BUCKETS)
+            shard.counts = [x + y for x, y in zip(shard.counts, counts)]
+            shard.put()
+        txn()
+
+    @classmethod
+    def reset(cls):
+        ndb.delete_multi(cls._shard_keys())
+
+    @classmethod
+    def get_counts(cls):
+        """Returns the number of players in each bucket"""
+        counts = [0] * SCORE_BUCKETS
+        for shard in ndb.get_multi(cls._shard_keys()):
+            if shard:
+                counts = [x + y for x, y in zip(counts, shard.counts)]
+        return counts
+
+    @classmethod
+    def get_rank(cls, score):
+        """Returns the rank of a player with score, the number of players
+        and whether the rank is exact. Players sharing a bucket are assumed
+        to be spread evenly across it"""
+        counts = cls.get_counts()
+        bucket = cls.bucket_for(score)
+        higher = sum(counts[bucket + 1:])
+        same = max(counts[bucket], 1)
+        total = max(sum(counts), higher + same)
+
+        if same == 1:
+            return higher + 1, total, True
+
+        if bucket == SCORE_BUCKETS - 1:
+            # The last bucket is open ended, so its players are unordered
+            position = 0
+        else:
+            bucket_top = (bucket + 1) * SCORE_BUCKET_WIDTH - 1
+            position = int(same * float(bucket_top - score) /
+                           SCORE_BUCKET_WIDTH)
+        return higher + 1 + min(position, same - 1), total, False
+
+
 class DataForm(messages.Message):
     """ScoreForm for outbound Score information"""
     user_name = messages.StringField(1, required=True)
@@ -45,6 +234,17 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
+
+
+class UserRankForm(messages.Message):
+    """UserRankForm for outbound rank information"""
+    user_name = messages.StringField(1, required=True)
+    score = messages.IntegerField(2, required=True)
+    rank = messages.IntegerField(3, required=True)
+    total_players = messages.IntegerField(4, required=True)
+    percentile = messages.FloatField(5, required=True)
+    exact = messages.BooleanField(6, required=True)
 
 
 class RankForm(messages.Message):
@@ -56,4 +256,5 @@ class RankForm(messages.Message):
 class RankForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(RankForm, 1, repeated=True)
+    next_page_token = messages.StringField(2)
 
@@ -1,16 +1,40 @@
 """TriviaGame.py - This file contains the class definitions for the Datastore
 entity TriviaGame. This class also includes methods 'new_game', 'to_form',
-'end_game', 'record_score', 'get_question_from_pool',
+'to_form_async', 'end_game', 'record_score', 'get_question_from_pool',
 'remove_question_from_pool', 'update_current_score', 'get_latest_turn',
-'register_turn', 'get_current_question', and 'clear_game' ."""
+'register_turn', 'start_turn', 'commit_turn', 'commit_turn_async',
+'merge_new_questions', 'get_cached', 'save_cached', 'flush_cached',
+'update_stored', 'get_turns', 'embed_legacy_turns', 'touch',
+'get_current_question', 'clear_game' and 'delete_games'."""
 
 import random
-from datetime import date
+from datetime import date, datetime
 from protorpc import messages
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import ndb
-from question import Question
+from question import Question, QuestionCatalogue, ALL_QUESTIONS
 from gamesummary import GameSummary
-from score import Score
+from score import Score, ScoreHistogram
+from migration import Migration, USER_KEYS
+from gamestats import GameStats
+from turn import TurnRecord
+
+# Extra questions sampled into a new game's pool on top of its rounds
+QUESTION_POOL_RESERVE = 2
+
+# Most questions added to the catalogue mid-game merged into a game's pool
+MAX_POOL_DELTA = 20
+
+# Games in progress are cached in memcache, which may hold state newer than
+# the datastore until the FlushGame task writes it
+MEMCACHE_GAME_PREFIX = 'game:'
+GAME_CACHE_TTL = 3600
+
+
+class GameConflictError(Exception):
+    """Raised when a cached game was saved by another request since it was
+    read"""
 
 
 class TriviaGame(ndb.Model):
@@ -19,79 +43,144 @@ class TriviaGame(ndb.Model):
     game_over = ndb.BooleanProperty(required=True, default=False)
     user = ndb.KeyProperty(required=True, kind='User')
     question_pool = ndb.KeyProperty(kind='Question', repeated=True)
+    turns = ndb.LocalStructuredProperty(TurnRecord, repeated=True,
+                                        compressed=True)
+    # Turns stored as separate Turn entities by earlier versions
     turn_keys = ndb.KeyProperty(kind='Turn', repeated=True)
     current_question = ndb.KeyProperty(kind='Question')
     current_score = ndb.IntegerProperty(required=True, default=0)
+    # Last time the player started, answered or asked for a clue
+    last_activity = ndb.DateTimeProperty()
+    # QuestionCatalogue partition the questions are drawn from, and the
+    # version of it the question pool has caught up with
+    partition = ndb.StringProperty(indexed=False, default=ALL_QUESTIONS)
+    catalogue_version = ndb.IntegerProperty(indexed=False)
+    # Game cache version of the state, so a late flush cannot overwrite a
+    # newer write
+    cache_version = ndb.IntegerProperty(indexed=False, default=0)
 
-    @classmethod
-    def new_game(cls, user, game_rounds):
-        """Creates and returns a new game"""
+    # get_cached manages memcache for TriviaGames itself
+    _use_memcache = False
 
-        q = Question.query()
-        questions = q.fetch()
-        questionKeys = [question.key for question in questions]
+    @classmethod
+    def new_game(cls, user, game_rounds, partition=ALL_QUESTIONS):
+        """Creates and returns a new game drawing its questions from the
+        catalogue of a partition"""
 
-        turnKeys = []
+        questionKeys = Question.sample_keys(game_rounds +
+                                            QUESTION_POOL_RESERVE, partition)
 
         game = TriviaGame(user=user,
                           rounds_remaining=game_rounds,
                           question_pool=questionKeys,
-                          turn_keys=turnKeys,
-                          game_over=False)
+                          turns=[],
+                          game_over=False,
+                          partition=partition,
+                          catalogue_version=QuestionCatalogue.get_size(
+                              partition))
+        game.touch()
         game.put()
         return game
 
     def to_form(self, message=None, options=None):
         """Returns a TriviaGameForm representation of the TriviaGame"""
+        return self.to_form_async(message, options).get_result()
+
+    @ndb.tasklet
+    def to_form_async(self, message=None, options=None):
+        """Tasklet returning a TriviaGameForm representation of the
+        TriviaGame"""
+        user = yield self.user.get_async()
         form = TriviaGameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = user.name
         form.rounds_remaining = self.rounds_remaining
         form.current_score = self.current_score
         form.game_over = self.game_over
         form.message = message
         if options:
             form.options = options
-        return form
+        raise ndb.Return(form)
 
     def end_game(self):
         """Ends the game."""
         self.game_over = True
-        self.put()
+        self.commit_turn()
         # Add the game to the game summary
         game_summary = GameSummary.new_game_summary(self.user,
                                                     self.key,
                                                     date.today(),
-                                                    self.turn_keys)
+                                                    self.get_turns())
         aggregates = game_summary.aggregate_data()
 
         self.record_score(aggregates)
+        GameStats.record_game(*aggregates)
         return game_summary
 
     def record_score(self, aggregate_data):
-        score = Score.query().filter(Score.user == self.user).get()
+        """Adds the game totals to the user's Score, read by key in a
+        transaction so games finishing together both count. Until the
+        BackfillUserKeys task has finished, a Score not yet keyed by the
+        user is merged into the keyed one first"""
+        if not Migration.is_finished(USER_KEYS):
+            legacy_keys = Score.legacy_keys_async(self.user).get_result()
+            if legacy_keys:
+                Score.merge_legacy(self.user, legacy_keys)
+        score, old_score = self._add_to_score(aggregate_data)
+        ScoreHistogram.move(old_score, score.score)
+        return score
+
+    @ndb.transactional(xg=True)
+    def _add_to_score(self, aggregate_data):
+        # Cross group, as a Score without a user name reads the User
+        score_key = Score.key_for(self.user)
+        score = score_key.get()
+        old_score = score.score if score else None
         if score:
             score.score += aggregate_data[0]
             score.num_correct += aggregate_data[1]
             score.num_incorrect += aggregate_data[2]
             score.clues_used += aggregate_data[3]
         else:
-            score = Score(user=self.user,
+            score = Score(key=score_key,
+                          user=self.user,
                           score=aggregate_data[0],
                           num_correct=aggregate_data[1],
                           num_incorrect=aggregate_data[2],
                           clues_used=aggregate_data[3])
 
+        # Keep the denormalized name filled in for the leaderboards
+        score.get_user_name()
         score.put()
-        return score
+        return score, old_score
 
     def get_question_from_pool(self):
-        """Supply a question key at random from the pool"""
+        """Supply a question key at random from the pool, after merging in
+        the questions added since the pool was last brought up to date"""
+        self.merge_new_questions()
         if len(self.question_pool) == 0:
             return None
 
         return random.choice(self.question_pool)
 
+    def merge_new_questions(self):
+        """Adds the questions created since the game last checked the
+        QuestionCatalogue to the pool, skipping any already asked. Games
+        written before the version was kept start tracking it from now"""
+        version = self.catalogue_version
+        if version is None:
+            self.catalogue_version = QuestionCatalogue.get_size(
+                self.partition)
+            return
+
+        new_keys, self.catalogue_version = QuestionCatalogue.keys_since(
+            version, MAX_POOL_DELTA, self.partition)
+        if new_keys:
+            asked = set(turn.question_key for turn in self.get_turns())
+            asked.update(self.question_pool)
+            self.question_pool.extend(key for key in new_keys
+                                      if key not in asked)
+
     def remove_question_from_pool(self, question_key):
         """Supply a question key at random from the pool"""
         if len(self.question_pool) == 0:
@@ -99,29 +188,228 @@ class TriviaGame(ndb.Model):
 
         removed_key = self.question_pool.remove(question_key)
         self.current_question = question_key
-        self.put()
         return removed_key
 
     def update_current_score(self, points):
         self.current_score += points
 
-    def register_turn(self, turn_key):
-        self.turn_keys.append(turn_key)
-        self.put()
+    def register_turn(self, turn):
+        self.get_turns().append(turn)
+
+    def start_turn(self, question_key):
+        """Builds the next turn for question_key and registers it with the
+        game. Nothing is written until commit_turn"""
+        turn = TurnRecord(question_key=question_key)
+        self.remove_question_from_pool(question_key)
+        self.register_turn(turn)
+        return turn
+
+    def commit_turn(self):
+        """Writes the game. Its turns are embedded, so the finished turn,
+        the next turn and the game state land in a single put"""
+        self.commit_turn_async().get_result()
+
+    @ndb.tasklet
+    def commit_turn_async(self):
+        """Starts writing the game and returns the Future of the put. The
+        game cache is updated first, so a concurrent turn fails with
+        GameConflictError before anything reaches the datastore, and the
+        cached state is only marked durable once the put has succeeded"""
+        self.touch()
+        cached = self.save_cached()
+        yield self.put_async()
+        if cached:
+            self._mark_durable()
+
+    def touch(self):
+        """Records player activity, which resets the reminder clock"""
+        self.last_activity = datetime.now()
+
+    @classmethod
+    def get_cached(cls, key):
+        """Returns the TriviaGame for key or None if it does not exist.
+        Games in progress are read from the game cache, filling it from the
+        datastore on a miss, and remember the cache version they were read
+        at for save_cached"""
+        client = memcache.Client()
+        cache_key = MEMCACHE_GAME_PREFIX + key.urlsafe()
+        entry = client.gets(cache_key)
+        if entry is None:
+            game = key.get()
+            if not game or game.game_over:
+                return game
+            client.add(cache_key,
+                       game._cache_entry(game.cache_version,
+                                         game.cache_version),
+                       time=GAME_CACHE_TTL)
+            entry = client.gets(cache_key)
+            if entry is None:
+                # Memcache is unavailable, the game is written through
+                return game
+
+        game = cls._from_cache_entry(entry)
+        game._cache_client = client
+        game._cas_fresh = True
+        return game
+
+    @classmethod
+    def _from_cache_entry(cls, entry):
+        game = ndb.model_from_protobuf(entity_pb.EntityProto(entry['pb']))
+        game._cache_version = entry['version']
+        game._durable_version = entry['durable']
+        return game
+
+    def _cache_entry(self, version, durable):
+        return {'pb': ndb.model_to_protobuf(self).Encode(),
+                'version': version,
+                'durable': durable}
+
+    def save_cached(self):
+        """Writes the game to the game cache with compare-and-set, as a new
+        version not yet in the datastore. The caller either puts it, as
+        commit_turn_async does, or leaves the put to flush_cached. Returns
+        False if the game was not read through the cache, in which case it
+        must be put. Raises GameConflictError if the cached game changed
+        since it was read"""
+        client = getattr(self, '_cache_client', None)
+        if client is None:
+            return False
+
+        cache_key = MEMCACHE_GAME_PREFIX + self.key.urlsafe()
+        if not self._cas_fresh:
+            # The cas id was used by an earlier save of this request
+            entry = client.gets(cache_key)
+            if entry is None or entry['version'] != self._cache_version:
+                raise GameConflictError('The game was changed by another '
+                                        'request')
+
+        self.cache_version = self._cache_version + 1
+        self._cas_fresh = False
+        if not client.cas(cache_key,
+                          self._cache_entry(self.cache_version,
+                                            self._durable_version),
+                          time=GAME_CACHE_TTL):
+            raise GameConflictError('The game was changed by another request')
+
+        self._cache_version = self.cache_version
+        return True
+
+    def _mark_durable(self):
+        """Records in the game cache that the version this request saved
+        has been put, unless a later save has replaced it since"""
+        client = self._cache_client
+        cache_key = MEMCACHE_GAME_PREFIX + self.key.urlsafe()
+        entry = client.gets(cache_key)
+        if entry is not None and entry['version'] == self._cache_version:
+            entry['durable'] = self._cache_version
+            client.cas(cache_key, entry, time=GAME_CACHE_TTL)
+        self._durable_version = self._cache_version
+
+    @classmethod
+    def flush_cached(cls, key):
+        """Puts the cached state of a game if its version is newer than the
+        one stored, then records it as durable unless it changed meanwhile"""
+        client = memcache.Client()
+        cache_key = MEMCACHE_GAME_PREFIX + key.urlsafe()
+        entry = client.gets(cache_key)
+        if entry is None or entry['version'] <= entry['durable']:
+            return
+
+        game = cls._from_cache_entry(entry)
+        game._cache_client = client
+
+        def put_if_newer():
+            # A cancelled game must not be written back, nor a turn that
+            # was put after this entry was read be overwritten
+            stored = key.get()
+            if stored and stored.cache_version < game.cache_version:
+                game.put()
+        ndb.transaction(put_if_newer)
+        client.cas(cache_key, game._cache_entry(entry['version'],
+                                                entry['version']),
+                   time=GAME_CACHE_TTL)
+
+    @classmethod
+    def update_stored(cls, key, update):
+        """Applies update, a function of the game that returns False to
+        leave it unchanged, and writes the game for a maintenance task. A
+        game in progress is read through the game cache and saved with
+        compare-and-set like a turn, so neither unflushed state nor a
+        concurrent turn is overwritten; other games are updated in a
+        transaction. Raises GameConflictError if the cached game changed
+        meanwhile. Returns True if the game was written"""
+        game = cls.get_cached(key)
+        if game is None:
+            return False
+
+        if getattr(game, '_cache_client', None) is None:
+            def update_in_transaction():
+                stored = key.get()
+                if stored is None or update(stored) is False:
+                    return False
+                stored.put()
+                return True
+            return ndb.transaction(update_in_transaction)
+
+        if update(game) is False:
+            return False
+        game.save_cached()
+
+        def put_if_newer():
+            stored = key.get()
+            if stored and stored.cache_version < game.cache_version:
+                game.put()
+                return True
+            return False
+        written = ndb.transaction(put_if_newer)
+        game._mark_durable()
+        return written
+
+    def _post_put_hook(self, future):
+        if getattr(self, '_cache_client', None) is None:
+            # Written outside the game cache, which would now be stale
+            memcache.delete(MEMCACHE_GAME_PREFIX + self.key.urlsafe())
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        memcache.delete(MEMCACHE_GAME_PREFIX + key.urlsafe())
+
+    def get_turns(self):
+        """Returns the TurnRecords of the game"""
+        self.embed_legacy_turns()
+        return self.turns
+
+    def embed_legacy_turns(self):
+        """Copies turns stored as separate Turn entities into the game. The
+        Turn entities are only deleted by the MigrateTurns task, once the
+        GameSummary that shares them has been migrated too"""
+        if self.turn_keys and not self.turns:
+            self.turns = [TurnRecord.from_turn(turn)
+                          for turn in ndb.get_multi(self.turn_keys) if turn]
 
     def get_latest_turn(self):
-        if len(self.turn_keys) == 0:
+        turns = self.get_turns()
+        if len(turns) == 0:
             return None
 
-        return self.turn_keys[-1]
+        return turns[-1]
 
     def get_current_question(self):
         return self.current_question
 
     def clear_game(self):
-        for turn in self.turn_keys:
-            turn.delete()
+        """Ends the game and deletes it with its legacy Turn entities"""
         self.game_over = True
+        TriviaGame.delete_games([self])
+
+    @classmethod
+    def delete_games(cls, games):
+        """Deletes the games and their legacy Turn entities in one batch"""
+        keys = []
+        for game in games:
+            keys.extend(game.turn_keys)
+            keys.append(game.key)
+        ndb.delete_multi(keys)
 
 
 class TriviaGameForm(messages.Message):
@@ -133,6 +421,7 @@ class TriviaGameForm(messages.Message):
     game_over = messages.BooleanField(5, required=True)
     message = messages.StringField(6, required=True)
     options = messages.StringField(7, repeated=True)
+    turn_token = messages.StringField(8)
 
 
 class TriviaGameForms(messages.Message):
@@ -144,4 +433,6 @@ class NewTriviaGameForm(messages.Message):
     """Used to create a new game"""
     user_name = messages.StringField(1, required=True)
     rounds = messages.IntegerField(4, default=5)
+    category = messages.StringField(5)
+    difficulty = messages.StringField(6)
 
@@ -1,6 +1,8 @@
 """turn.py - This file contains the class definitions for the Datastore
-entity Turns. This classes also includes methods 'new_turn', 'set_correct_answer', 
-'set_finished', 'used_clue', 'set_anwer_given'  and 'set_points'."""
+entity Turns. This classes also includes methods 'set_correct_answer',
+'set_finished', 'used_clue', 'set_anwer_given'  and 'set_points'.
+TurnRecord holds the same data embedded in a TriviaGame or GameSummary, the
+Turn entity only remains for games stored before turns were embedded."""
 
 import random
 from datetime import date
@@ -8,10 +10,8 @@ from protorpc import messages
 from google.appengine.ext import ndb
 
 
-class Turn(ndb.Model):
-    """Turn object"""
-    game_key = ndb.KeyProperty(required=True, kind='TriviaGame')
-    user_key = ndb.KeyProperty(required=True, kind='User')
+class TurnRecord(ndb.Model):
+    """Turn record, stored inside TriviaGame and GameSummary"""
     question_key = ndb.KeyProperty(required=True, kind='Question')
     given_answer = ndb.TextProperty(required=True, default='')
     clues_used = ndb.IntegerProperty(default=0)
@@ -20,13 +20,14 @@ class Turn(ndb.Model):
     is_finished = ndb.BooleanProperty(required=True, default=False)
 
     @classmethod
-    def new_turn(cls, game, user, question):
-        # Creats a new Turn object
-        triviaGameTurn = Turn(game_key=game,
-                              user_key=user,
-                              question_key=question)
-        triviaGameTurn.put()
-        return triviaGameTurn
+    def from_turn(cls, turn):
+        """Returns a TurnRecord copy of a legacy Turn entity"""
+        return cls(question_key=turn.question_key,
+                   given_answer=turn.given_answer,
+                   clues_used=turn.clues_used,
+                   points=turn.points,
+                   is_correct=turn.is_correct,
+                   is_finished=turn.is_finished)
 
     def set_correct_answer(self):
         self.is_correct = True
@@ -43,3 +44,8 @@ class Turn(ndb.Model):
     def set_answer_given(self, answer):
         self.given_answer = answer
 
+
+class Turn(TurnRecord):
+    """Turn object"""
+    game_key = ndb.KeyProperty(required=True, kind='TriviaGame')
+    user_key = ndb.KeyProperty(required=True, kind='User')
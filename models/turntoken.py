@@ -0,0 +1,103 @@
+"""turntoken.py - This file contains the class definitions for the Datastore
+entity TurnTokenSecret and for TurnToken, a signed and expiring description
+of the question a turn asks. take_turn grades an answer from a valid token
+without reading the Question; 'issue' signs a token and 'parse' checks one."""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+from google.appengine.ext import ndb
+
+# Seconds a turn token can be used for grading after it was issued
+TURN_TOKEN_TTL = 3600
+
+_secret = None
+
+
+class TurnTokenSecret(ndb.Model):
+    """TurnTokenSecret object. The HMAC key turn tokens are signed with,
+    generated the first time a token is issued"""
+    value = ndb.StringProperty(required=True, indexed=False)
+
+    @classmethod
+    def get_secret(cls):
+        """Returns the signing key, kept in memory once read"""
+        global _secret
+        if _secret is None:
+            _secret = str(cls.get_or_insert(
+                'turn_token', value=os.urandom(32).encode('hex')).value)
+        return _secret
+
+
+class TurnToken(object):
+    """A turn token names the game, the position of the turn in it and its
+    question, and carries the question's points and a keyed fingerprint of
+    its correct answer"""
+    def __init__(self, game_key, turn_number, question_key, value,
+                 fingerprint, expires):
+        self.game_key = game_key
+        self.turn_number = turn_number
+        self.question_key = question_key
+        self.value = value
+        self.fingerprint = fingerprint
+        self.expires = expires
+
+    @staticmethod
+    def _sign(data):
+        return hmac.new(TurnTokenSecret.get_secret(), data,
+                        hashlib.sha256).hexdigest()
+
+    @classmethod
+    def _fingerprint(cls, question_key, answer):
+        return cls._sign('answer:{}:{}'.format(
+            question_key.urlsafe(), answer.encode('utf-8')))
+
+    @classmethod
+    def issue(cls, game, question):
+        """Returns a signed token for the latest turn of the game, which
+        asks question"""
+        payload = {'g': game.key.urlsafe(),
+                   'n': len(game.get_turns()) - 1,
+                   'q': question.key.urlsafe(),
+                   'v': question.value,
+                   'a': cls._fingerprint(question.key,
+                                         question.answers['correct']),
+                   'e': int(time.time()) + TURN_TOKEN_TTL}
+        data = base64.urlsafe_b64encode(json.dumps(payload))
+        return '{}.{}'.format(data, cls._sign(data))
+
+    @classmethod
+    def parse(cls, token):
+        """Returns the TurnToken a token string holds, or None if it is
+        malformed, forged or expired"""
+        try:
+            data, signature = str(token).split('.')
+            if not hmac.compare_digest(cls._sign(data), signature):
+                return None
+            payload = json.loads(base64.urlsafe_b64decode(data))
+            parsed = cls(ndb.Key(urlsafe=str(payload['g'])), payload['n'],
+                         ndb.Key(urlsafe=str(payload['q'])), payload['v'],
+                         str(payload['a']), payload['e'])
+        except Exception:
+            return None
+
+        if parsed.expires < time.time():
+            return None
+        return parsed
+
+    def matches(self, game):
+        """Returns True if the token describes the latest turn of the game"""
+        turns = game.get_turns()
+        return (self.game_key == game.key and
+                self.turn_number == len(turns) - 1 and
+                self.question_key == turns[-1].question_key)
+
+    def is_correct_answer(self, answer):
+        """Determines if an answer is the correct answer"""
+        if answer is None:
+            return False
+        return hmac.compare_digest(
+            self._fingerprint(self.question_key, answer), self.fingerprint)
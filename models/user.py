@@ -1,10 +1,15 @@
 """User.py - This file contains the class definitions for the Datastore
-entity known as User."""
+entity known as User. Users are keyed by their name, so looking one up is a
+get by key. Users created before that are found through a UserName entity
+written by the BackfillUserKeys task (/tasks/backfill_user_keys). This class
+also includes methods 'new_user' and 'get_by_name'."""
 
 import random
 from datetime import date
 from protorpc import messages
 from google.appengine.ext import ndb
+from score import Score
+from migration import Migration, USER_KEYS
 
 
 class User(ndb.Model):
@@ -12,3 +17,48 @@ class User(ndb.Model):
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
 
+    @classmethod
+    def get_by_name(cls, name):
+        """Returns the User with name or None. The user and the UserName of
+        a user created before users were keyed by name are read in one
+        batch. Until the BackfillUserKeys task has finished, users without
+        a UserName yet are found by query"""
+        if not name:
+            return None
+        user, user_name = ndb.get_multi([ndb.Key(cls, name),
+                                         ndb.Key(UserName, name)])
+        if user is None and user_name is not None:
+            user = user_name.user.get()
+        if user is None and not Migration.is_finished(USER_KEYS):
+            user = cls.query(cls.name == name).get()
+        return user
+
+    @classmethod
+    def new_user(cls, name, email):
+        """Creates and returns a new user keyed by name together with its
+        Score, or returns None if the name is already taken. Until the
+        BackfillUserKeys task has finished, the names of users without a
+        UserName yet are checked by query, which cannot run in the
+        transaction"""
+        if not Migration.is_finished(USER_KEYS) and \
+                cls.query(cls.name == name).get(keys_only=True):
+            return None
+        return cls._insert(name, email)
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def _insert(cls, name, email):
+        if any(ndb.get_multi([ndb.Key(cls, name), ndb.Key(UserName, name)])):
+            return None
+
+        user = cls(id=name, name=name, email=email)
+        score = Score(key=Score.key_for(user.key), user=user.key,
+                      user_name=name)
+        ndb.put_multi([user, score])
+        return user
+
+
+class UserName(ndb.Model):
+    """UserName object. Its id is the name of a User created before users
+    were keyed by name, and it points at that User"""
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
@@ -0,0 +1,75 @@
+"""support.py - Shared setup for the tests and the benchmark. Puts the App
+Engine SDK named by APPENGINE_SDK on sys.path and activates the testbed
+service stubs the app uses. Test cases that need the SDK are decorated with
+requires_sdk, so they are skipped when it is not available."""
+
+import os
+import sys
+import unittest
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SDK = os.environ.get('APPENGINE_SDK')
+
+
+def setup_sdk(sdk_path):
+    """Puts the App Engine SDK and its bundled libraries on sys.path"""
+    if sdk_path in sys.path:
+        return
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+
+def setup_testbed():
+    """Activates the service stubs the app uses and returns the testbed"""
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=APP_ROOT)
+    bed.init_app_identity_stub()
+    bed.init_blobstore_stub()
+    bed.init_mail_stub()
+    return bed
+
+
+def seed_questions(count):
+    """Imports count generated questions and returns them"""
+    from models import Question
+
+    questions = [Question.from_row(
+        {'question': u'Question {}?'.format(i),
+         'correct': u'right {}'.format(i),
+         'wrong1': u'wrong {}a'.format(i),
+         'wrong2': u'wrong {}b'.format(i),
+         'wrong3': u'wrong {}c'.format(i),
+         'clue1': u'first clue {}'.format(i),
+         'clue2': u'second clue {}'.format(i)}) for i in range(count)]
+    Question.import_questions(questions)
+    return questions
+
+
+def call_api(method, container, **fields):
+    """Calls a TriviaApi method as the endpoints server would, with the
+    combined request message of its ResourceContainer, as a new request
+    with an empty ndb context cache"""
+    from google.appengine.ext import ndb
+    import api
+
+    ndb.get_context().clear_cache()
+    request = container.combined_message_class(**fields)
+    return getattr(api.TriviaApi(), method)(request)
+
+
+if SDK:
+    setup_sdk(SDK)
+if APP_ROOT not in sys.path:
+    sys.path.insert(0, APP_ROOT)
+
+requires_sdk = unittest.skipUnless(
+    SDK, 'set APPENGINE_SDK to the google_appengine directory')
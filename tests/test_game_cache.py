@@ -0,0 +1,146 @@
+"""test_game_cache.py - Tests of the game cache. Games are played through
+TriviaApi and flushed through main.app against the App Engine testbed
+datastore, memcache and taskqueue stubs, checking the compare-and-set,
+versioning and flush logic of TriviaGame.
+
+Usage:
+    APPENGINE_SDK=<path to google_appengine> \\
+        python -m unittest discover -s tests -t .
+"""
+
+import unittest
+
+from tests import support
+
+if support.SDK:
+    import endpoints
+    import webapp2
+    from google.appengine.api import memcache
+    from google.appengine.ext import ndb
+
+    import api
+    import main
+    from models import User, TriviaGame, GameConflictError
+    from models.triviagame import MEMCACHE_GAME_PREFIX
+
+
+@support.requires_sdk
+class GameCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.bed = support.setup_testbed()
+        ndb.get_context().clear_cache()
+        support.seed_questions(10)
+        User.new_user('alice', 'alice@example.com')
+        form = support.call_api('new_triva_game', api.NEW_TRIVIA_GAME_REQUEST,
+                                user_name='alice', rounds=3)
+        self.urlsafe = form.urlsafe_key
+        self.key = ndb.Key(urlsafe=self.urlsafe)
+        self.cache_key = MEMCACHE_GAME_PREFIX + self.urlsafe
+
+    def tearDown(self):
+        self.bed.deactivate()
+
+    def call(self, method, container=None, **fields):
+        return support.call_api(method,
+                                container or api.GET_TRIVIA_GAME_REQUEST,
+                                urlsafe_trivia_game_key=self.urlsafe,
+                                **fields)
+
+    def take_turn(self, ans=u'no answer'):
+        return self.call('take_turn', api.TAKE_TURN_REQUEST, ans=ans)
+
+    def flush(self):
+        request = webapp2.Request.blank('/tasks/flush_game',
+                                        POST={'game': self.urlsafe})
+        response = request.get_response(main.app)
+        self.assertEqual(response.status_int, 204)
+
+    def flush_racing(self, action):
+        """Runs FlushGame, with action run right after it read the game
+        cache, as a request racing the flush would"""
+        gets = memcache.Client.gets
+
+        def gets_then_act(client, *args, **kwargs):
+            memcache.Client.gets = gets
+            entry = gets(client, *args, **kwargs)
+            action()
+            return entry
+        memcache.Client.gets = gets_then_act
+        self.addCleanup(setattr, memcache.Client, 'gets', gets)
+        self.flush()
+
+    def stored(self):
+        ndb.get_context().clear_cache()
+        return self.key.get()
+
+    def test_late_flush_does_not_overwrite_a_newer_turn(self):
+        self.call('get_trivia_game')
+        self.call('get_clue', api.GET_CLUE_REQUEST)
+        clue_version = memcache.get(self.cache_key)['version']
+
+        self.flush_racing(self.take_turn)
+
+        game = self.stored()
+        self.assertEqual(game.cache_version, clue_version + 1)
+        self.assertEqual(game.rounds_remaining, 2)
+        self.assertEqual(len(game.turns), 2)
+        self.assertTrue(game.turns[0].is_finished)
+        self.assertEqual(game.turns[0].clues_used, 1)
+        entry = memcache.get(self.cache_key)
+        self.assertEqual(entry['version'], clue_version + 1)
+        self.assertEqual(entry['durable'], clue_version + 1)
+
+    def test_flush_after_cancel_does_not_restore_the_game(self):
+        self.call('get_trivia_game')
+        entry = memcache.get(self.cache_key)
+        self.assertGreater(entry['version'], entry['durable'])
+
+        self.flush_racing(lambda: self.call('cancel_trivia_game'))
+
+        self.assertIsNone(self.stored())
+        self.assertIsNone(memcache.get(self.cache_key))
+
+    def test_second_of_two_concurrent_saves_conflicts(self):
+        self.call('get_trivia_game')
+        ndb.get_context().clear_cache()
+        first = TriviaGame.get_cached(self.key)
+        second = TriviaGame.get_cached(self.key)
+
+        first.get_latest_turn().used_clue()
+        self.assertTrue(first.save_cached())
+
+        second.get_latest_turn().used_clue()
+        self.assertRaises(GameConflictError, second.save_cached)
+        self.assertRaises(endpoints.ConflictException,
+                          api.TriviaApi._save_game_state, second)
+
+        entry = memcache.get(self.cache_key)
+        self.assertEqual(entry['version'], first.cache_version)
+
+    def test_evicted_game_is_refilled_at_the_stored_version(self):
+        self.call('get_trivia_game')
+        self.take_turn()
+        stored_version = self.stored().cache_version
+
+        memcache.flush_all()
+        ndb.get_context().clear_cache()
+        game = TriviaGame.get_cached(self.key)
+
+        entry = memcache.get(self.cache_key)
+        self.assertEqual(entry['version'], stored_version)
+        self.assertEqual(entry['durable'], stored_version)
+        self.assertEqual(game.cache_version, stored_version)
+        self.assertEqual(len(game.turns), 2)
+
+        # A save from the refilled entry is the next version and is flushed
+        game.get_latest_turn().used_clue()
+        self.assertTrue(game.save_cached())
+        self.assertEqual(game.cache_version, stored_version + 1)
+        self.flush()
+        stored = self.stored()
+        self.assertEqual(stored.cache_version, stored_version + 1)
+        self.assertEqual(stored.turns[-1].clues_used, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
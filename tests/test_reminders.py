@@ -0,0 +1,130 @@
+"""test_reminders.py - Tests of the reminder pipeline. SendReminders and
+SendMail run through main.app against the App Engine testbed datastore,
+taskqueue and mail stubs.
+
+Usage:
+    APPENGINE_SDK=<path to google_appengine> \\
+        python -m unittest discover -s tests -t .
+"""
+
+import unittest
+from datetime import datetime, timedelta
+
+from tests import support
+
+if support.SDK:
+    import webapp2
+    from google.appengine.ext import ndb
+    from google.appengine.ext import testbed
+
+    import main
+    from main import CUTOFF_FORMAT, MAIL_QUEUE
+    from models import User, TriviaGame
+
+
+@support.requires_sdk
+class ReminderTest(unittest.TestCase):
+    def setUp(self):
+        self.bed = support.setup_testbed()
+        ndb.get_context().clear_cache()
+        self.taskqueue = self.bed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        self.mail = self.bed.get_stub(testbed.MAIL_SERVICE_NAME)
+        support.seed_questions(10)
+
+    def tearDown(self):
+        self.bed.deactivate()
+
+    def idle_game(self, user, hours=2):
+        """Returns a started game of user last played hours ago"""
+        game = TriviaGame.new_game(user.key, 3)
+        game.start_turn(game.get_question_from_pool())
+        game.commit_turn()
+        game.last_activity = datetime.now() - timedelta(hours=hours)
+        game.put()
+        return game
+
+    def post(self, url, **params):
+        request = webapp2.Request.blank(url, POST=params)
+        return request.get_response(main.app)
+
+    def send_reminders(self):
+        cutoff = datetime.now() - timedelta(hours=main.REMINDER_IDLE_HOURS)
+        response = self.post('/tasks/send_reminders',
+                             cutoff=cutoff.strftime(CUTOFF_FORMAT))
+        self.assertEqual(response.status_int, 204)
+
+    def mail_tasks(self):
+        return self.taskqueue.get_filtered_tasks(queue_names=[MAIL_QUEUE])
+
+    def test_queues_one_reminder_per_idle_user(self):
+        alice = User.new_user('alice', 'alice@example.com')
+        bob = User.new_user('bob', 'bob@example.com')
+        self.idle_game(alice)
+        self.idle_game(bob)
+
+        self.send_reminders()
+
+        tasks = self.mail_tasks()
+        self.assertEqual(len(tasks), 2)
+        self.assertEqual(sorted(task.extract_params()['to'] for task in tasks),
+                         ['alice@example.com', 'bob@example.com'])
+        for task in tasks:
+            self.assertEqual(task.url, '/tasks/send_mail')
+
+    def test_skips_recent_and_unreachable_players(self):
+        alice = User.new_user('alice', 'alice@example.com')
+        carol = User.new_user('carol', None)
+        self.idle_game(alice, hours=0)
+        self.idle_game(carol)
+
+        self.send_reminders()
+
+        self.assertEqual(self.mail_tasks(), [])
+
+    def test_one_reminder_per_user_for_several_idle_games(self):
+        alice = User.new_user('alice', 'alice@example.com')
+        self.idle_game(alice)
+        self.idle_game(alice)
+
+        self.send_reminders()
+
+        self.assertEqual(len(self.mail_tasks()), 1)
+
+    def test_one_reminder_per_user_per_day(self):
+        alice = User.new_user('alice', 'alice@example.com')
+        self.idle_game(alice)
+
+        self.send_reminders()
+        self.send_reminders()
+
+        tasks = self.mail_tasks()
+        self.assertEqual(len(tasks), 1)
+        self.assertIn(datetime.now().strftime('%Y%m%d'), tasks[0].name)
+
+    def test_queued_reminder_is_sent(self):
+        alice = User.new_user('alice', 'alice@example.com')
+        self.idle_game(alice)
+        self.send_reminders()
+
+        task, = self.mail_tasks()
+        params = task.extract_params()
+        response = self.post(task.url, **params)
+
+        self.assertEqual(response.status_int, 204)
+        message, = self.mail.get_sent_messages(to='alice@example.com')
+        self.assertEqual(message.subject, params['subject'])
+        self.assertIn('Hi alice', message.body.decode())
+
+    def test_send_mail(self):
+        response = self.post('/tasks/send_mail', to='bob@example.com',
+                             subject='Hello', body='Come back')
+
+        self.assertEqual(response.status_int, 204)
+        message, = self.mail.get_sent_messages(to='bob@example.com')
+        self.assertEqual(message.subject, 'Hello')
+        self.assertEqual(message.body.decode(), 'Come back')
+        self.assertTrue(message.sender.startswith('noreply@'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+"""test_turntoken.py - Tests of the turn tokens take_turn grades answers
+from. Tokens are issued by TriviaApi for games played against the App
+Engine testbed datastore and memcache stubs, and checked to be rejected
+when tampered with, expired or not for the current turn of the game.
+
+Usage:
+    APPENGINE_SDK=<path to google_appengine> \\
+        python -m unittest discover -s tests -t .
+"""
+
+import base64
+import json
+import time
+import unittest
+
+from tests import support
+
+if support.SDK:
+    from google.appengine.ext import ndb
+
+    import api
+    from models import User, TriviaGame, TurnToken
+
+
+@support.requires_sdk
+class TurnTokenTest(unittest.TestCase):
+    def setUp(self):
+        self.bed = support.setup_testbed()
+        ndb.get_context().clear_cache()
+        support.seed_questions(10)
+        User.new_user('alice', 'alice@example.com')
+
+    def tearDown(self):
+        self.bed.deactivate()
+
+    def new_game(self):
+        """Returns the urlsafe key of a new game with its first turn
+        started, and the form of that turn"""
+        game = support.call_api('new_triva_game',
+                                api.NEW_TRIVIA_GAME_REQUEST,
+                                user_name='alice', rounds=3)
+        form = support.call_api('get_trivia_game',
+                                api.GET_TRIVIA_GAME_REQUEST,
+                                urlsafe_trivia_game_key=game.urlsafe_key)
+        return game.urlsafe_key, form
+
+    def take_turn(self, urlsafe, ans, turn_token=None):
+        return support.call_api('take_turn', api.TAKE_TURN_REQUEST,
+                                urlsafe_trivia_game_key=urlsafe, ans=ans,
+                                turn_token=turn_token)
+
+    def game(self, urlsafe):
+        ndb.get_context().clear_cache()
+        return TriviaGame.get_cached(ndb.Key(urlsafe=urlsafe))
+
+    def current_question(self, urlsafe):
+        return self.game(urlsafe).get_current_question().get()
+
+    @staticmethod
+    def split(token):
+        data, signature = token.split('.')
+        return json.loads(base64.urlsafe_b64decode(data)), signature
+
+    @staticmethod
+    def encode(payload):
+        return base64.urlsafe_b64encode(json.dumps(payload))
+
+    def test_issued_token_matches_its_turn(self):
+        urlsafe, form = self.new_game()
+        question = self.current_question(urlsafe)
+
+        token = TurnToken.parse(form.turn_token)
+
+        self.assertIsNotNone(token)
+        self.assertTrue(token.matches(self.game(urlsafe)))
+        self.assertEqual(token.value, question.value)
+        self.assertTrue(token.is_correct_answer(question.answers['correct']))
+        self.assertFalse(token.is_correct_answer(question.answers['wrong1']))
+        self.assertFalse(token.is_correct_answer(None))
+
+    def test_tampered_payload_is_rejected(self):
+        urlsafe, form = self.new_game()
+        payload, signature = self.split(form.turn_token)
+
+        payload['v'] = 1000
+        forged = '{}.{}'.format(self.encode(payload), signature)
+
+        self.assertIsNone(TurnToken.parse(forged))
+
+    def test_tampered_signature_is_rejected(self):
+        urlsafe, form = self.new_game()
+        data, signature = form.turn_token.split('.')
+        flipped = signature[:-1] + ('0' if signature[-1] != '0' else '1')
+
+        self.assertIsNone(TurnToken.parse('{}.{}'.format(data, flipped)))
+        self.assertIsNone(TurnToken.parse(data + '.'))
+        self.assertIsNone(TurnToken.parse(data))
+        self.assertIsNone(TurnToken.parse('not a token'))
+
+    def test_expired_token_is_rejected(self):
+        urlsafe, form = self.new_game()
+        payload, signature = self.split(form.turn_token)
+
+        payload['e'] = int(time.time()) + 60
+        data = self.encode(payload)
+        valid = '{}.{}'.format(data, TurnToken._sign(data))
+        self.assertIsNotNone(TurnToken.parse(valid))
+
+        payload['e'] = int(time.time()) - 1
+        data = self.encode(payload)
+        expired = '{}.{}'.format(data, TurnToken._sign(data))
+        self.assertIsNone(TurnToken.parse(expired))
+
+    def test_token_for_an_earlier_turn_does_not_match(self):
+        urlsafe, form = self.new_game()
+        self.take_turn(urlsafe, u'no answer', form.turn_token)
+
+        token = TurnToken.parse(form.turn_token)
+        self.assertIsNotNone(token)
+        self.assertFalse(token.matches(self.game(urlsafe)))
+
+    def test_token_for_another_game_does_not_match(self):
+        urlsafe, form = self.new_game()
+        other_urlsafe, other_form = self.new_game()
+
+        token = TurnToken.parse(other_form.turn_token)
+        self.assertTrue(token.matches(self.game(other_urlsafe)))
+        self.assertFalse(token.matches(self.game(urlsafe)))
+
+    def test_stale_token_is_ignored_and_the_question_grades(self):
+        urlsafe, first_form = self.new_game()
+        first_question = self.current_question(urlsafe)
+        self.take_turn(urlsafe, u'no answer', first_form.turn_token)
+        question = self.current_question(urlsafe)
+        self.assertNotEqual(question.key, first_question.key)
+
+        # Graded by the stale token, the first question's answer would pass
+        form = self.take_turn(urlsafe, first_question.answers['correct'],
+                              first_form.turn_token)
+        self.assertTrue(form.message.startswith('You are not correct'))
+
+        urlsafe, first_form = self.new_game()
+        first_question = self.current_question(urlsafe)
+        self.take_turn(urlsafe, u'no answer', first_form.turn_token)
+        question = self.current_question(urlsafe)
+
+        form = self.take_turn(urlsafe, question.answers['correct'],
+                              first_form.turn_token)
+        self.assertTrue(form.message.startswith('You are correct'))
+        self.assertEqual(form.current_score, question.value)
+
+    def test_valid_token_grades_without_reading_the_question(self):
+        urlsafe, form = self.new_game()
+        question = self.current_question(urlsafe)
+        answer = question.answers['correct']
+
+        # Nothing can grade from the Question once it is gone
+        question.key.delete()
+
+        form = self.take_turn(urlsafe, answer, form.turn_token)
+        self.assertTrue(form.message.startswith('You are correct'))
+        self.assertEqual(form.current_score, question.value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,24 +1,39 @@
 """utils.py - File for collecting general utility functions."""
 
+import hashlib
 import logging
+import re
+import time
+import urllib
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
+# Triggers of the same task within this many seconds share a single run
+TASK_COALESCE_WINDOW = 60
+MEMCACHE_TASK_PREFIX = 'task:'
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key the urlsafe key string encodes without fetching
+        the entity. Raises an error if the key String is malformed or points
+        at the incorrect kind
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
     Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
+        The ndb.Key the urlsafe Key string encodes.
     Raises:
         ValueError:"""
+    key = _key_from_urlsafe(urlsafe)
+    if key.kind() != model._get_kind():
+        raise ValueError('Incorrect Kind')
+    return key
+
+def _key_from_urlsafe(urlsafe):
     try:
-        key = ndb.Key(urlsafe=urlsafe)
+        return ndb.Key(urlsafe=urlsafe)
     except TypeError:
         raise endpoints.BadRequestException('Invalid Key')
     except Exception, e:
@@ -27,6 +42,21 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
+def get_by_urlsafe(urlsafe, model):
+    """Returns an ndb.Model entity that the urlsafe key points to. Checks
+        that the type of entity returned is of the correct kind. Raises an
+        error if the key String is malformed or the entity is of the incorrect
+        kind
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        The entity that the urlsafe Key string points to or None if no entity
+        exists.
+    Raises:
+        ValueError:"""
+    key = _key_from_urlsafe(urlsafe)
+
     entity = key.get()
     if not entity:
         return None
@@ -34,5 +64,72 @@ def get_by_urlsafe(urlsafe, model):
         raise ValueError('Incorrect Kind')
     return entity
 
-def getFirstKey(item):
-    return item[1]
+def get_cursor_by_urlsafe(page_token):
+    """Returns the query Cursor a page token encodes, or None when there is
+        no token. Raises an error if the token is malformed
+    Args:
+        page_token: A urlsafe cursor string from a previous response
+    Returns:
+        The Cursor to continue the query from.
+    Raises:
+        BadRequestException:"""
+    if not page_token:
+        return None
+    try:
+        return Cursor(urlsafe=page_token)
+    except Exception:
+        raise endpoints.BadRequestException('Invalid page token')
+
+def get_page_size(requested, default, maximum):
+    """Returns the requested page size bounded to [1, maximum], or default
+        when none was requested"""
+    if not requested or requested < 1:
+        return default
+    return min(requested, maximum)
+
+def schedule_task(url, params=None, window=TASK_COALESCE_WINDOW,
+                  queue_name='default'):
+    """Adds a push task that runs at most once per window of seconds, no
+        matter how many times it is scheduled. The task is named after the
+        url, its params and the current window, so the task queue drops
+        duplicates, and a memcache flag saves the add RPC for repeats. The
+        task runs when the window closes, after every trigger in it.
+        Pass window=None to schedule exactly once for the given params,
+        which makes retried continuation tasks idempotent.
+    Args:
+        url: The task handler url
+        params: A dict of task parameters
+        window: The coalescing window in seconds, or None
+        queue_name: The push queue to add the task to
+    Returns:
+        True if this call added the task."""
+    now = time.time()
+    if window:
+        bucket = int(now // window)
+        countdown = int(window - now % window)
+    else:
+        bucket = 0
+        countdown = 0
+
+    # urlencode calls str() on each value, so unicode is encoded first
+    params = dict((name, value.encode('utf-8')
+                   if isinstance(value, unicode) else value)
+                  for name, value in (params or {}).items())
+    identity = '{}?{}'.format(url, urllib.urlencode(sorted(params.items())))
+    name = '{}-{}-{}'.format(re.sub(r'[^a-zA-Z0-9-]', '-', url.strip('/')),
+                             hashlib.sha1(identity).hexdigest()[:16], bucket)
+
+    if not memcache.add(MEMCACHE_TASK_PREFIX + name, True,
+                        time=window or 3600):
+        return False
+
+    try:
+        taskqueue.add(url=url, params=params, name=name,
+                      countdown=countdown, queue_name=queue_name)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        return False
+    except Exception:
+        # Let the next trigger try again
+        memcache.delete(MEMCACHE_TASK_PREFIX + name)
+        raise
+    return True